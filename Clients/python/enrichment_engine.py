@@ -0,0 +1,306 @@
+"""
+Async enrichment engine shared by the llama.cpp and Ollama clients.
+
+A fixed number of workers, one per server slot, pull batches from a work queue.
+Items whose review is missing or invalid go back to the queue and have priority
+over fresh items, but they are merged into full batches and never wait for a
+round to finish. Every item is retried up to max_retries times before it is
+given up on.
+
+Transient errors (server unreachable, restarting or overloaded) are not the
+items' fault: they do not count against max_retries, and the worker waits an
+exponentially growing delay, shared by all workers, before trying again.
+"""
+
+import asyncio
+import json
+import random
+import urllib.request
+from abc import ABC, abstractmethod
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, List
+
+import tqdm
+from pydantic import BaseModel, Field, ValidationError, create_model
+
+from enrichment_io import ResultWriter
+
+PROMPT_INSTRUCTION = """
+                You are a helpful assistant that classifies and reviews items.
+
+                Each item has:
+                - "item_id": unique id for each item
+                - "description": the item's description
+
+                Return a JSON object with a "reviews" array containing objects with the following keys:
+                - "item_id" : same as item_id from input
+                - "classification" : classification of item category
+                - "review" : small review 1-2 phrases max
+
+                Example format:
+                {
+                  "reviews": [
+                    {
+                      "item_id": 1,
+                      "classification": "Electronics",
+                      "review": "Great product with excellent features."
+                    }
+                  ]
+                }
+                """
+
+
+class ItemReview(BaseModel):
+    item_id: int = Field(description="unique identifier that is provided in the input.", title="item_id")
+    classification: str = Field(description="The classification of the item (e.g.,Food,cloths).")
+    review: str = Field(description="A brief review of the item.")
+
+
+class Response(BaseModel):
+    reviews: List[ItemReview] = Field(description="A list of classifications and reviews for the provided items.")
+
+
+@lru_cache(maxsize=None)
+def response_model(size: int) -> type[BaseModel]:
+    """Response schema pinned to exactly size reviews, batches of retried items can be smaller."""
+    return create_model(f"Response{size}",
+                        reviews=(List[ItemReview], Field(min_length=size, max_length=size,
+                                                         description="A list of classifications and reviews for the provided items.")))
+
+
+def dict_to_text(items: list[dict]) -> str:
+    lines = []
+    for item in items:
+        line = "\n".join([f"{key} : {value}" for key, value in item.items()])
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def create_prompt(batch_items: list[dict]) -> list[dict]:
+    number_of_items = len(batch_items)
+    batch_items_text = dict_to_text(batch_items)
+    return [
+        {"role": "system", "content": PROMPT_INSTRUCTION},
+        {"role": "user", "content": f"The following {number_of_items} items need to be classified and reviewed. Please return exactly {number_of_items} reviews in JSON format:\n\n{batch_items_text}"},
+    ]
+
+
+class Backend(ABC):
+    """Chat API the engine sends its batches to."""
+
+    @abstractmethod
+    async def complete(self, context: list[dict], size: int) -> str:
+        """Returns the raw JSON content generated for a batch of size items."""
+
+    async def slots(self) -> int | None:
+        """Parallel slots of the server, None when it cannot be asked."""
+        return None
+
+    def is_transient(self, error: Exception) -> bool:
+        """Whether the request failed because of the server rather than the items, worth retrying later."""
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class OpenAIBackend(Backend):
+    """OpenAI compatible API, e.g. llama.cpp server."""
+
+    def __init__(self, base_url: str, model: str = "gpt-3.5-turbo", api_key: str = "sk-no-key-required",
+                 temperature: float = 1, timeout: float = 60) -> None:
+        from openai import AsyncOpenAI
+        self.base_url = base_url
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        self.model = model
+        self.temperature = temperature
+        self.timeout = timeout
+
+    async def complete(self, context: list[dict], size: int) -> str:
+        response = await self.client.chat.completions.create(
+            messages=context,  # type: ignore
+            model=self.model,
+            response_format={"type": "json_schema",
+                             "json_schema": {"name": "reviews", "schema": response_model(size).model_json_schema()}},
+            temperature=self.temperature,
+            timeout=self.timeout,
+        )
+        return response.choices[0].message.content or ""
+
+    async def slots(self) -> int | None:
+        # llama.cpp reports its -np setting on /props, next to the /v1 API
+        url = self.base_url.rstrip("/").removesuffix("/v1") + "/props"
+        def fetch() -> int | None:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return json.load(response).get("total_slots")
+        try:
+            return await asyncio.to_thread(fetch)
+        except Exception:
+            return None
+
+    def is_transient(self, error: Exception) -> bool:
+        from openai import APIConnectionError, InternalServerError, RateLimitError
+        # APITimeoutError is an APIConnectionError, llama.cpp answers 503 while loading the model
+        return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError)) or super().is_transient(error)
+
+
+class OllamaBackend(Backend):
+    """Ollama chat API, parallelism is the server's OLLAMA_NUM_PARALLEL."""
+
+    def __init__(self, host: str, model: str, options: dict | None = None, keep_alive: int = 20) -> None:
+        from ollama import AsyncClient
+        self.client = AsyncClient(host)
+        self.model = model
+        self.options = options or {}
+        self.keep_alive = keep_alive
+
+    async def complete(self, context: list[dict], size: int) -> str:
+        response = await self.client.chat(
+            messages=context,
+            model=self.model,
+            format=response_model(size).model_json_schema(),
+            keep_alive=self.keep_alive,
+            stream=False,
+            options=self.options,
+        )
+        return response.message.content or ""
+
+    def is_transient(self, error: Exception) -> bool:
+        import httpx
+        from ollama import ResponseError
+        if isinstance(error, ResponseError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, httpx.TransportError) or super().is_transient(error)
+
+
+class WorkQueue:
+    """Fresh items read lazily from an iterator, retried items served first."""
+
+    def __init__(self, items: Iterator[dict], batch_size: int) -> None:
+        self.items = items
+        self.batch_size = batch_size
+        self.retries: deque[dict] = deque()
+        self.exhausted = False
+
+    def next_batch(self) -> list[dict]:
+        batch = [self.retries.popleft() for _ in range(min(self.batch_size, len(self.retries)))]
+        if len(batch) < self.batch_size and not self.exhausted:
+            fresh = list(islice(self.items, self.batch_size - len(batch)))
+            self.exhausted = len(fresh) < self.batch_size - len(batch)
+            batch.extend(fresh)
+        return batch
+
+    def retry(self, items: list[dict]) -> None:
+        self.retries.extend(items)
+
+
+class EnrichmentEngine:
+    """Runs the workers and keeps the retry accounting."""
+
+    def __init__(self, backend: Backend, writer: ResultWriter, batch_size: int = 5,
+                 concurrency: int | None = None, max_retries: int = 3,
+                 min_backoff: float = 1, max_backoff: float = 60) -> None:
+        self.backend = backend
+        self.writer = writer
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.attempts: dict[int, int] = {}
+        self.failed: list[int] = []
+        self.in_flight = 0
+        self.changed = asyncio.Condition()
+
+    def parse(self, content: str, batch_items: list[dict]) -> list[dict]:
+        """Valid reviews of the batch items, the ones missing are retried by the caller."""
+        result = Response.model_validate_json(content)
+        expected = {item["item_id"] for item in batch_items}
+        reviews = {}
+        for review in result.reviews:
+            if review.item_id in expected:
+                reviews[review.item_id] = review.model_dump()
+        return list(reviews.values())
+
+    def give_back(self, queue: WorkQueue, items: list[dict]) -> None:
+        retry = []
+        for item in items:
+            attempts = self.attempts.get(item["item_id"], 0) + 1
+            if attempts > self.max_retries:
+                self.attempts.pop(item["item_id"], None)
+                self.failed.append(item["item_id"])
+                print(f"item {item['item_id']} failed {attempts - 1} times, giving up")
+            else:
+                self.attempts[item["item_id"]] = attempts
+                retry.append(item)
+        queue.retry(retry)
+
+    async def worker(self, queue: WorkQueue, pbar: tqdm.tqdm) -> None:
+        while True:
+            async with self.changed:
+                batch_items = queue.next_batch()
+                while not batch_items:
+                    if queue.exhausted and not queue.retries and self.in_flight == 0:
+                        self.changed.notify_all()
+                        return
+                    # in-flight batches may still hand items back
+                    await self.changed.wait()
+                    batch_items = queue.next_batch()
+                self.in_flight += 1
+            transient = False
+            try:
+                content = await self.backend.complete(create_prompt(batch_items), len(batch_items))
+                reviews = self.parse(content, batch_items)
+            except (ValidationError, ValueError) as e:
+                print(f"invalid response for items {[item['item_id'] for item in batch_items]}: {e}")
+                reviews = []
+            except Exception as e:
+                transient = self.backend.is_transient(e)
+                print(f"request failed for items {[item['item_id'] for item in batch_items]}: {e}")
+                reviews = []
+            if transient:
+                # the batch is held while waiting so idle workers do not resend it right away
+                await self.wait_backoff()
+                async with self.changed:
+                    queue.retry(batch_items)
+                    self.in_flight -= 1
+                    self.changed.notify_all()
+                continue
+            self.backoff = 0.0
+            done = {review["item_id"] for review in reviews}
+            self.writer.write(reviews)
+            for item_id in done:
+                self.attempts.pop(item_id, None)
+            pbar.update(len(done))
+            pbar.set_postfix({"Reviews": self.writer.written + len(self.writer.buffer),
+                              "Retrying": len(queue.retries), "Failed": len(self.failed)})
+            async with self.changed:
+                self.give_back(queue, [item for item in batch_items if item["item_id"] not in done])
+                self.in_flight -= 1
+                self.changed.notify_all()
+
+    async def wait_backoff(self) -> None:
+        """Sleeps the shared delay, doubled by every transient failure up to max_backoff."""
+        self.backoff = min(self.max_backoff, max(self.min_backoff, self.backoff * 2))
+        delay = self.backoff * random.uniform(0.5, 1)
+        print(f"server unavailable, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def run(self, items: Iterator[dict], total: int) -> int:
+        """
+        Enrich every item and write the reviews as they arrive.
+
+        Returns:
+            Number of reviews written
+        """
+        concurrency = self.concurrency or await self.backend.slots() or 4
+        queue = WorkQueue(items, self.batch_size)
+        pbar = tqdm.tqdm(total=total, desc="Processing items", unit="items")
+        try:
+            await asyncio.gather(*(self.worker(queue, pbar) for _ in range(concurrency)))
+        finally:
+            self.writer.close()
+            pbar.close()
+        if self.failed:
+            print(f"{len(self.failed)} items could not be enriched, they are picked up again on the next run")
+        return self.writer.written
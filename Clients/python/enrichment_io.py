@@ -0,0 +1,98 @@
+"""
+Streaming input and incremental output for the enrichment clients.
+
+The input parquet is scanned lazily and read one slice at a time, so only the
+current slice is held in memory. Results are appended to an output directory as
+small parquet part files as they complete. On restart, the item_ids already
+written are skipped, so a crash only loses the results not yet flushed.
+"""
+
+import glob
+import os
+import time
+from typing import Iterator
+
+import polars as pl
+
+RESULT_SCHEMA = {"item_id": pl.Int64, "classification": pl.String, "review": pl.String}
+
+
+def read_done_ids(output_dir: str) -> pl.Series:
+    """item_ids already written by previous runs, kept as one compact integer column."""
+    parts = glob.glob(os.path.join(output_dir, "part-*.parquet"))
+    if not parts:
+        return pl.Series("item_id", [], dtype=pl.Int64)
+    return pl.scan_parquet(parts).select("item_id").unique().sort("item_id").collect()["item_id"]
+
+
+def count_items(path: str) -> int:
+    # answered from the parquet metadata, no row is read
+    return pl.scan_parquet(path).select(pl.len()).collect().item()
+
+
+def stream_items(path: str, done_ids: pl.Series, slice_rows: int = 10_000) -> Iterator[dict]:
+    """
+    Yield {"item_id", "description"} items slice by slice, skipping the ones already done.
+
+    item_id is the 1-based row number of the input file, as it always was, so it
+    stays the same across restarts.
+    """
+    data = pl.scan_parquet(path).with_row_index("item_id", offset=1).select(pl.col("item_id").cast(pl.Int64), "description")
+    done_ids = done_ids.sort()
+    total = count_items(path)
+    for offset in range(0, total, slice_rows):
+        # only the done ids falling in this slice are looked up
+        low, high = done_ids.search_sorted(pl.Series([offset + 1, offset + slice_rows + 1])).to_list()
+        items = data.slice(offset, slice_rows).filter(~pl.col("item_id").is_in(done_ids[low:high].implode())).collect()
+        yield from items.iter_rows(named=True)
+
+
+class ResultWriter:
+    """Buffers results and flushes them to a new part file every flush_rows results or flush_seconds."""
+
+    def __init__(self, output_dir: str, flush_rows: int = 500, flush_seconds: float = 60) -> None:
+        self.output_dir = output_dir
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer: list[dict] = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+        os.makedirs(output_dir, exist_ok=True)
+        parts = glob.glob(os.path.join(output_dir, "part-*.parquet"))
+        self.part = max((int(os.path.basename(part)[5:11]) for part in parts), default=-1) + 1
+
+    def write(self, reviews: list[dict]) -> None:
+        self.buffer.extend(reviews)
+        if len(self.buffer) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        rows = pl.DataFrame(self.buffer, schema=RESULT_SCHEMA).unique("item_id", keep="last")
+        path = os.path.join(self.output_dir, f"part-{self.part:06d}.parquet")
+        # written under a temporary name first so a crash never leaves a truncated part
+        rows.write_parquet(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        self.part += 1
+        self.written += rows.height
+        self.buffer = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+def compact_results(output_dir: str, path: str, clusters: pl.DataFrame | None = None) -> None:
+    """
+    Merge the part files into one parquet once the job is done.
+
+    With near-duplicate clusters (item_id -> representative_id), every member gets
+    the review of its representative.
+    """
+    reviews = pl.scan_parquet(os.path.join(output_dir, "part-*.parquet")).unique("item_id", keep="last")
+    if clusters is not None:
+        reviews = (clusters.lazy()
+                   .join(reviews.rename({"item_id": "representative_id"}), on="representative_id")
+                   .select(*RESULT_SCHEMA, "representative_id"))
+    reviews.sort("item_id").sink_parquet(path)
@@ -0,0 +1,157 @@
+"""
+Near-duplicate collapsing with MinHash LSH before enrichment.
+
+Descriptions are reduced to MinHash signatures over character shingles and
+bucketed with LSH. An item whose estimated Jaccard similarity with an earlier
+representative reaches the threshold joins that representative's cluster, so only
+representatives are sent to the model. compact_results fans the representative's
+review out to every member.
+
+The pre-pass streams the input one slice at a time, but the LSH index keeps the
+signature and bucket keys of every representative, about 1.5 KB per cluster, so
+its memory grows with the number of distinct descriptions rather than staying
+flat. The item_id -> representative_id map is written with a fingerprint of the
+input and reused when the job restarts on the same input.
+"""
+
+import json
+import os
+import re
+from typing import Iterator
+
+import numpy as np
+import polars as pl
+
+from enrichment_io import count_items
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+SEED = 1
+
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM) -> tuple[int, int]:
+    """
+    Pick the bands x rows split minimising false positives below and false negatives above threshold.
+
+    A pair of similarity s shares a bucket with probability 1 - (1 - s^rows)^bands.
+    """
+    s = np.linspace(0, 1, 1001)
+    best, best_error = (num_perm, 1), np.inf
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        candidate = 1 - (1 - s**rows) ** bands
+        error = np.mean(np.where(s < threshold, candidate, 1 - candidate))
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """MinHash over byte shingles with multiply-shift hash permutations."""
+
+    def __init__(self, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = SEED) -> None:
+        rng = np.random.default_rng(seed)
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str | None) -> np.ndarray:
+        # sizes, colours and reseller copies differ in a few words, case and spacing are noise
+        data = np.frombuffer(re.sub(r"\s+", " ", (text or "").lower()).strip().encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+        if data.size < self.shingle_size:
+            data = np.pad(data, (0, self.shingle_size - data.size))
+        grams = np.zeros(data.size - self.shingle_size + 1, dtype=np.uint64)
+        for offset in range(self.shingle_size):
+            grams = (grams << np.uint64(8)) | data[offset:data.size - self.shingle_size + 1 + offset]
+        return np.unique(grams)
+
+    def signature(self, text: str | None) -> np.ndarray:
+        grams = self.shingles(text)
+        with np.errstate(over="ignore"):
+            hashed = (self.a[:, None] * grams[None, :] + self.b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+class LSHIndex:
+    """LSH buckets of the representatives seen so far."""
+
+    def __init__(self, threshold: float, num_perm: int = NUM_PERM) -> None:
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.buckets: dict[tuple[int, bytes], int] = {}
+        self.signatures: dict[int, np.ndarray] = {}
+
+    def _keys(self, signature: np.ndarray) -> list[tuple[int, bytes]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def assign(self, item_id: int, signature: np.ndarray) -> int:
+        """Returns the representative of the item, the item itself when it starts a new cluster."""
+        keys = self._keys(signature)
+        candidates = {self.buckets[key] for key in keys if key in self.buckets}
+        best, best_similarity = item_id, self.threshold
+        for candidate in candidates:
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best == item_id:
+            self.signatures[item_id] = signature
+            for key in keys:
+                self.buckets.setdefault(key, item_id)
+        return best
+
+
+def iter_descriptions(path: str, slice_rows: int) -> Iterator[pl.DataFrame]:
+    data = pl.scan_parquet(path).with_row_index("item_id", offset=1).select(pl.col("item_id").cast(pl.Int64), "description")
+    for offset in range(0, count_items(path), slice_rows):
+        yield data.slice(offset, slice_rows).collect()
+
+
+def input_fingerprint(path: str, threshold: float) -> dict:
+    """Row count, size and mtime of the input with the threshold, a map built from anything else is stale."""
+    stat = os.stat(path)
+    return {"rows": count_items(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "threshold": threshold}
+
+
+def build_clusters(path: str, clusters_path: str, threshold: float | None = 0.8, slice_rows: int = 10_000) -> pl.DataFrame:
+    """
+    Map every item_id to the representative_id of its near-duplicate cluster.
+
+    The map is read back from clusters_path when the fingerprint stored next to it
+    (clusters_path.json) matches the input and threshold, it is rebuilt otherwise,
+    e.g. after items were added. A None threshold disables collapsing.
+    """
+    if threshold is None:
+        return (pl.scan_parquet(path).with_row_index("item_id", offset=1)
+                .select(pl.col("item_id").cast(pl.Int64), pl.col("item_id").cast(pl.Int64).alias("representative_id"))
+                .collect())
+    fingerprint = input_fingerprint(path, threshold)
+    if os.path.exists(clusters_path) and os.path.exists(f"{clusters_path}.json"):
+        with open(f"{clusters_path}.json") as file:
+            if json.load(file) == fingerprint:
+                return pl.read_parquet(clusters_path)
+        print(f"{path} changed since {clusters_path} was built, rebuilding the near-duplicate clusters")
+    hasher = MinHasher()
+    index = LSHIndex(threshold)
+    frames = []
+    for items in iter_descriptions(path, slice_rows):
+        representatives = [index.assign(item_id, hasher.signature(description))
+                           for item_id, description in items.iter_rows()]
+        frames.append(pl.DataFrame({"item_id": items["item_id"], "representative_id": representatives},
+                                   schema={"item_id": pl.Int64, "representative_id": pl.Int64}))
+    clusters = pl.concat(frames) if frames else pl.DataFrame(schema={"item_id": pl.Int64, "representative_id": pl.Int64})
+    os.makedirs(os.path.dirname(clusters_path) or ".", exist_ok=True)
+    clusters.write_parquet(f"{clusters_path}.tmp")
+    os.replace(f"{clusters_path}.tmp", clusters_path)
+    # written last, a crash in between leaves a map without fingerprint that is rebuilt
+    with open(f"{clusters_path}.json", "w") as file:
+        json.dump(fingerprint, file)
+    collapsed = clusters.filter(pl.col("item_id") != pl.col("representative_id")).height
+    print(f"{collapsed} of {clusters.height} items are near duplicates ({len(index.signatures)} clusters), they will not be sent to the model")
+    return clusters
+
+
+def duplicate_ids(clusters: pl.DataFrame) -> pl.Series:
+    """item_ids covered by their cluster representative, to skip in stream_items."""
+    return clusters.filter(pl.col("item_id") != pl.col("representative_id"))["item_id"]
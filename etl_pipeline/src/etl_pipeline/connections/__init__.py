@@ -0,0 +1 @@
+from .supabase_io import SupabaseIO, inFilter
\ No newline at end of file
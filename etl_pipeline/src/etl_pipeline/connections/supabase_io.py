@@ -0,0 +1,124 @@
+"""
+Shared async I/O layer for Supabase storage and tables.
+
+This module talks to the Storage and PostgREST HTTP APIs through one pooled
+httpx.AsyncClient, so extraction, KPI upserts, gold uploads and file moves reuse
+keep-alive (and HTTP/2 when available) connections instead of hopping threads
+around the synchronous client.
+"""
+
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, List
+
+import httpx
+
+from ..models import IOConfig
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK = 1024 * 1024
+
+
+def inFilter(values: List[Any]) -> str:
+    """PostgREST in.(...) filter, values are quoted so commas and parentheses stay literal."""
+    quoted = ",".join('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values)
+    return f"in.({quoted})"
+
+
+class SupabaseIO:
+    """Async Supabase storage/table client over a bounded connection pool."""
+
+    def __init__(self, url: str, key: str, config: IOConfig) -> None:
+        self.url = url.rstrip("/")
+        self.config = config
+        http2 = config.http2 and importlib.util.find_spec("h2") is not None
+        if config.http2 and not http2:
+            logger.info("h2 is not installed, falling back to HTTP/1.1 keep-alive")
+        # all calls go to the project host, so the pool limits are the per-host limits
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=config.timeout,
+            limits=httpx.Limits(max_connections=config.max_connections,
+                                max_keepalive_connections=config.max_keepalive_connections),
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+        )
+
+    async def list(self, bucket: str, path: str, order: str = "asc") -> List[dict]:
+        response = await self.client.post(
+            f"{self.url}/storage/v1/object/list/{bucket}",
+            json={"prefix": path, "limit": 1000, "offset": 0,
+                  "sortBy": {"column": "created_at", "order": order}})
+        response.raise_for_status()
+        return response.json()
+
+    async def download(self, bucket: str, path: str) -> bytes:
+        response = await self.client.get(f"{self.url}/storage/v1/object/{bucket}/{path}")
+        response.raise_for_status()
+        return response.content
+
+    async def upload(self, bucket: str, path: str, data: bytes, content_type: str = "application/json", upsert: bool = False) -> None:
+        response = await self.client.post(
+            f"{self.url}/storage/v1/object/{bucket}/{path}",
+            content=data,
+            headers={"Content-Type": content_type, "cache-control": "max-age=0", "x-upsert": str(upsert).lower()})
+        response.raise_for_status()
+
+    async def uploadFile(self, bucket: str, path: str, local_path: str, content_type: str = "application/json",
+                         upsert: bool = False) -> None:
+        """Streams a local file to storage in UPLOAD_CHUNK pieces, it is never held in memory as a whole."""
+        async def chunks() -> AsyncIterator[bytes]:
+            with open(local_path, "rb") as file:
+                while chunk := await asyncio.to_thread(file.read, UPLOAD_CHUNK):
+                    yield chunk
+        response = await self.client.post(
+            f"{self.url}/storage/v1/object/{bucket}/{path}",
+            content=chunks(),
+            headers={"Content-Type": content_type, "Content-Length": str(os.path.getsize(local_path)),
+                     "cache-control": "max-age=0", "x-upsert": str(upsert).lower()})
+        response.raise_for_status()
+
+    async def move(self, bucket: str, source: str, destination: str) -> None:
+        response = await self.client.post(
+            f"{self.url}/storage/v1/object/move",
+            json={"bucketId": bucket, "sourceKey": source, "destinationKey": destination})
+        response.raise_for_status()
+
+    async def select(self, table: str, columns: str = "*", filters: dict[str, str] | None = None,
+                     order: str | None = None, page_size: int = 1000) -> List[dict]:
+        """
+        Reads every row matching filters, page by page like utils.fetch_all.
+
+        Args:
+            table: Table name
+            columns: PostgREST select list
+            filters: PostgREST filters by column, e.g. {"id": inFilter(ids)}
+            order: Comma separated columns giving the pages a total order
+            page_size: Rows per request, not above the server max-rows
+        """
+        params = {"select": columns, **(filters or {})}
+        if order:
+            params["order"] = order
+        rows: List[dict] = []
+        while True:
+            response = await self.client.get(f"{self.url}/rest/v1/{table}",
+                                             params={**params, "limit": page_size, "offset": len(rows)})
+            response.raise_for_status()
+            page = response.json()
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+
+    async def upsert(self, table: str, records: List[dict[str, Any]], on_conflict: str) -> None:
+        response = await self.client.post(
+            f"{self.url}/rest/v1/{table}",
+            params={"on_conflict": on_conflict},
+            content=json.dumps(records, default=str),
+            headers={"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"})
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        await self.client.aclose()
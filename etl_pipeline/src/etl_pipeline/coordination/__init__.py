@@ -0,0 +1,2 @@
+from .lease_store import LeaseStore, SQLiteLeaseStore, StorageLeaseStore, TableLeaseStore
+from .file_leaser import FileLeaser, createLeaseStore
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+File sharding between concurrent ETL workers.
+
+Each worker claims a disjoint set of to_process files through leases and keeps
+them alive with a heartbeat thread until the files are moved to processed.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, List
+
+from supabase import Client as SPClient
+
+from ..models import ETLConfig
+from .lease_store import LeaseStore, SQLiteLeaseStore, StorageLeaseStore, TableLeaseStore
+
+logger = logging.getLogger(__name__)
+
+
+def createLeaseStore(config: ETLConfig, sp_client: SPClient) -> LeaseStore:
+    coordination = config.coordination
+    if coordination.store == "storage":
+        return StorageLeaseStore(sp_client, config.bucket_name, coordination.lease_prefix)
+    if coordination.store == "table":
+        return TableLeaseStore(sp_client, coordination.lease_table)
+    return SQLiteLeaseStore(coordination.sqlite_path)
+
+
+class FileLeaser:
+    """Claims files for this worker and renews the claims in the background."""
+
+    def __init__(self, config: ETLConfig, store: LeaseStore) -> None:
+        self.config = config.coordination
+        self.store = store
+        self.worker_id = self.config.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.held: set[str] = set()
+        self.lost: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: threading.Thread | None = None
+
+    def claim(self, files: List[str]) -> List[str]:
+        """
+        Leases up to max_files of the listed files, skipping the ones held by live workers.
+
+        Expired leases of crashed workers are taken over here as well.
+
+        Args:
+            files: Files listed in the to_process folder, oldest first
+
+        Returns:
+            The files this worker now owns, in listing order
+        """
+        claimed = []
+        for file in files:
+            if len(claimed) >= self.config.max_files:
+                break
+            if self.store.acquire(f"file/{file}", self.worker_id, self.config.lease_ttl):
+                claimed.append(file)
+        with self._lock:
+            self.held.update(claimed)
+            self.lost.clear()
+        logger.info(f"worker {self.worker_id} claimed {len(claimed)} of {len(files)} files")
+        if claimed:
+            self.startHeartbeat()
+        return claimed
+
+    def resume(self, files: List[str], worker_id: str) -> bool:
+        """
+        Takes back the leases an earlier process claimed as worker_id, e.g. the extract stage.
+
+        Returns:
+            False if another worker took one of the files over in between
+        """
+        self.worker_id = worker_id
+        held = [file for file in files if self.store.acquire(f"file/{file}", worker_id, self.config.lease_ttl)]
+        with self._lock:
+            self.held = set(held)
+            self.lost = set(files) - self.held
+        if held:
+            self.startHeartbeat()
+        return len(held) == len(files)
+
+    def startHeartbeat(self) -> None:
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renewLoop, daemon=True)
+        self._heartbeat.start()
+
+    def _renewLoop(self) -> None:
+        while not self._stop.wait(self.config.heartbeat_interval):
+            with self._lock:
+                held = list(self.held)
+            for file in held:
+                if not self.store.renew(f"file/{file}", self.worker_id, self.config.lease_ttl):
+                    logger.warning(f"worker {self.worker_id} lost the lease on {file}")
+                    with self._lock:
+                        self.held.discard(file)
+                        self.lost.add(file)
+
+    def holdsAll(self) -> bool:
+        """False if any lease was lost, the results must then not be published."""
+        with self._lock:
+            return not self.lost
+
+    def release(self, files: List[str]) -> None:
+        """Gives up the leases of claimed files this worker will not process, e.g. already moved by another one."""
+        with self._lock:
+            self.held.difference_update(files)
+        for file in files:
+            self.store.release(f"file/{file}", self.worker_id)
+
+    def releaseAll(self) -> None:
+        self._stop.set()
+        with self._lock:
+            held, self.held = list(self.held), set()
+        for file in held:
+            self.store.release(f"file/{file}", self.worker_id)
+
+    @contextmanager
+    def exclusive(self, name: str) -> Iterator[None]:
+        """
+        Holds a short lease on name, waiting for other workers to release it.
+
+        Used to serialise the read-merge-upsert of the KPI tables.
+        """
+        deadline = time.monotonic() + self.config.lease_ttl
+        delay = 0.05
+        while not self.store.acquire(name, self.worker_id, self.config.lease_ttl):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"could not acquire lease {name} within {self.config.lease_ttl}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        try:
+            yield
+        finally:
+            self.store.release(name, self.worker_id)
+
+    @asynccontextmanager
+    async def exclusiveAsync(self, name: str) -> AsyncIterator[None]:
+        """exclusive for the event loop, only the lease store calls run in a thread."""
+        deadline = time.monotonic() + self.config.lease_ttl
+        delay = 0.05
+        while not await asyncio.to_thread(self.store.acquire, name, self.worker_id, self.config.lease_ttl):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"could not acquire lease {name} within {self.config.lease_ttl}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.store.release, name, self.worker_id)
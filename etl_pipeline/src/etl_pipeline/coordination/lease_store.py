@@ -0,0 +1,188 @@
+"""
+Lease stores for coordinating several ETL workers.
+
+A lease gives one worker exclusive ownership of a name (a to_process file or a
+KPI table) until it expires. Workers renew their leases with heartbeats and any
+worker may take over a lease once it has expired.
+"""
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from supabase import Client as SPClient
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseStore(ABC):
+    """Interface of a lease backend."""
+
+    @abstractmethod
+    def acquire(self, name: str, worker_id: str, ttl: float) -> bool:
+        """Take the lease if it is free, expired or already ours."""
+
+    @abstractmethod
+    def renew(self, name: str, worker_id: str, ttl: float) -> bool:
+        """Extend a lease we hold, False if it was lost."""
+
+    @abstractmethod
+    def release(self, name: str, worker_id: str) -> None:
+        """Give a lease up so other workers can take it immediately."""
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Local stand-in, for several workers on one host or for development."""
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, worker_id TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, worker_id: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self.connection.execute(
+                "INSERT INTO leases (name, worker_id, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at "
+                "WHERE leases.expires_at < ? OR leases.worker_id = excluded.worker_id",
+                (name, worker_id, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def renew(self, name: str, worker_id: str, ttl: float) -> bool:
+        with self._lock:
+            cursor = self.connection.execute(
+                "UPDATE leases SET expires_at = ? WHERE name = ? AND worker_id = ?",
+                (time.time() + ttl, name, worker_id))
+            return cursor.rowcount == 1
+
+    def release(self, name: str, worker_id: str) -> None:
+        with self._lock:
+            self.connection.execute("DELETE FROM leases WHERE name = ? AND worker_id = ?", (name, worker_id))
+
+
+class TableLeaseStore(LeaseStore):
+    """
+    Leases as rows of a Supabase table.
+
+    Expected schema: name text primary key, worker_id text, expires_at float8.
+    Expired leases are taken over with a compare-and-swap update on expires_at.
+    """
+
+    def __init__(self, sp_client: SPClient, table: str) -> None:
+        self.sp_client = sp_client
+        self.table = table
+
+    def acquire(self, name: str, worker_id: str, ttl: float) -> bool:
+        now = time.time()
+        row = {"name": name, "worker_id": worker_id, "expires_at": now + ttl}
+        try:
+            self.sp_client.from_(self.table).insert(row).execute()
+            return True
+        except Exception:
+            # the primary key is taken, fall through to the takeover path
+            pass
+        try:
+            current = self.sp_client.from_(self.table).select("*").eq("name", name).execute().data
+            if not current:
+                return False
+            current = current[0]
+            if current["worker_id"] != worker_id and current["expires_at"] >= now:
+                return False
+            updated = (self.sp_client.from_(self.table).update(row)
+                       .eq("name", name).eq("expires_at", current["expires_at"]).execute().data)
+            return bool(updated)
+        except Exception as e:
+            logger.error(f"Error acquiring lease {name}: {e}")
+            return False
+
+    def renew(self, name: str, worker_id: str, ttl: float) -> bool:
+        try:
+            updated = (self.sp_client.from_(self.table).update({"expires_at": time.time() + ttl})
+                       .eq("name", name).eq("worker_id", worker_id).execute().data)
+            return bool(updated)
+        except Exception as e:
+            logger.error(f"Error renewing lease {name}: {e}")
+            return False
+
+    def release(self, name: str, worker_id: str) -> None:
+        try:
+            self.sp_client.from_(self.table).delete().eq("name", name).eq("worker_id", worker_id).execute()
+        except Exception as e:
+            logger.error(f"Error releasing lease {name}: {e}")
+
+
+class StorageLeaseStore(LeaseStore):
+    """
+    Leases as marker objects in the storage bucket, no extra table needed.
+
+    Creating a marker relies on upload with upsert disabled. Storage has no
+    compare-and-swap, so taking over an expired marker is re-checked by reading it
+    back; prefer the table or SQLite store when takeovers are frequent.
+    """
+
+    def __init__(self, sp_client: SPClient, bucket_name: str, prefix: str) -> None:
+        self.sp_client = sp_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _path(self, name: str) -> str:
+        return f"{self.prefix}/{name.replace('/', '__')}.lease"
+
+    def _write(self, name: str, worker_id: str, ttl: float, upsert: bool) -> None:
+        marker = json.dumps({"worker_id": worker_id, "expires_at": time.time() + ttl,
+                             "written_at": datetime.datetime.now().isoformat()}).encode("utf-8")
+        (self.sp_client.storage
+            .from_(self.bucket_name)
+            .upload(path=self._path(name), file=marker,
+                    file_options={"cache-control": "0", "upsert": upsert})) # type:ignore
+
+    def _read(self, name: str) -> dict | None:
+        try:
+            return json.loads(self.sp_client.storage.from_(self.bucket_name).download(self._path(name)))
+        except Exception:
+            return None
+
+    def acquire(self, name: str, worker_id: str, ttl: float) -> bool:
+        try:
+            self._write(name, worker_id, ttl, upsert=False)
+            return True
+        except Exception:
+            pass
+        current = self._read(name)
+        if current is None or (current["worker_id"] != worker_id and current["expires_at"] >= time.time()):
+            return False
+        try:
+            self._write(name, worker_id, ttl, upsert=True)
+        except Exception as e:
+            logger.error(f"Error acquiring lease {name}: {e}")
+            return False
+        current = self._read(name)
+        return current is not None and current["worker_id"] == worker_id
+
+    def renew(self, name: str, worker_id: str, ttl: float) -> bool:
+        current = self._read(name)
+        if current is None or current["worker_id"] != worker_id:
+            return False
+        try:
+            self._write(name, worker_id, ttl, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Error renewing lease {name}: {e}")
+            return False
+
+    def release(self, name: str, worker_id: str) -> None:
+        current = self._read(name)
+        if current is None or current["worker_id"] != worker_id:
+            return
+        try:
+            self.sp_client.storage.from_(self.bucket_name).remove([self._path(name)])
+        except Exception as e:
+            logger.error(f"Error releasing lease {name}: {e}")
@@ -0,0 +1,153 @@
+"""
+Long-running ETL daemon.
+
+This module keeps one ETLPipeline (and its LLM/Supabase connection pools) alive,
+polls the to_process folder on an interval and exposes a small HTTP server with
+a trigger and a status endpoint, plus the KPI read API when it is enabled.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class ETLDaemon:
+    """Runs ETLPipeline on a poll interval or on demand through HTTP."""
+
+    def __init__(self, pipeline: Any) -> None:
+        self.pipeline = pipeline
+        self.config = pipeline.config.daemon
+        self.status: dict[str, Any] = {
+            "state": "idle",
+            "runs": 0,
+            "published": 0,
+            "last_started": None,
+            "last_finished": None,
+            "last_duration": None,
+            "last_error": None,
+        }
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._trigger: asyncio.Event | None = None
+
+    def getStatus(self) -> dict[str, Any]:
+        with self._lock:
+            status = dict(self.status)
+        if self.pipeline.query_service is not None:
+            status["query"] = self.pipeline.query_service.stats()
+        return status
+
+    def _update(self, **values: Any) -> None:
+        with self._lock:
+            self.status.update(values)
+
+    def trigger(self) -> bool:
+        """Wakes the poll loop up, callable from any thread."""
+        if self._loop is None or self._trigger is None:
+            return False
+        self._loop.call_soon_threadsafe(self._trigger.set)
+        return True
+
+    async def runOnce(self) -> None:
+        started = time.monotonic()
+        self._update(state="running", last_started=datetime.datetime.now().isoformat())
+        try:
+            published = await self.pipeline.runAsync()
+            self._update(last_error=None)
+            if published:
+                with self._lock:
+                    self.status["published"] += 1
+        except Exception as e:
+            logger.error(f"ETL pipeline failed: {e}")
+            self._update(last_error=str(e))
+        finally:
+            with self._lock:
+                self.status["runs"] += 1
+            self._update(state="idle",
+                         last_finished=datetime.datetime.now().isoformat(),
+                         last_duration=time.monotonic() - started)
+
+    async def pollLoop(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._trigger = asyncio.Event()
+        while True:
+            await self.runOnce()
+            try:
+                await asyncio.wait_for(self._trigger.wait(), timeout=self.config.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._trigger.clear()
+
+    def serve(self) -> None:
+        """Starts the HTTP server in a background thread and polls forever in the main thread."""
+        query_service = self.pipeline.query_service
+        if query_service is not None:
+            query_service.refresh()
+        server = ThreadingHTTPServer((self.config.host, self.config.port),
+                                     makeHandler(self.getStatus, self.trigger,
+                                                 query_service.query if query_service is not None else None))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"ETL daemon listening on {self.config.host}:{self.config.port}, polling every {self.config.poll_interval}s")
+        try:
+            asyncio.run(self.pollLoop())
+        finally:
+            server.shutdown()
+
+
+def makeHandler(get_status: Callable[[], dict], trigger: Callable[[], bool],
+                query: Callable[[str, dict[str, str]], tuple[int, bytes]] | None = None) -> type[BaseHTTPRequestHandler]:
+    """
+    Builds the request handler for the daemon HTTP server.
+
+    Routes:
+        GET /health   liveness probe
+        GET /status   state of the last and current runs
+        POST /trigger start a run now instead of waiting for the next poll
+        GET /kpis/shops/top?k=10                          top shops by normalized_likeness_score
+        GET /kpis/users/<id>                              KPIs of one user
+        GET /kpis/dates?start=YYYY-MM-DD&end=YYYY-MM-DD   daily KPIs of a date range
+        GET /kpis/cube?grain=week&start=&end=&shop_id=    rollup cube rows, when the rollup is enabled
+        GET /kpis/sketches/<name>                         reach, top_shops, top_users or price_quantiles estimates
+    The /kpis routes are only served when a query callable is given.
+    """
+
+    class DaemonHandler(BaseHTTPRequestHandler):
+        def _send(self, code: int, body: dict) -> None:
+            self._sendPayload(code, json.dumps(body).encode("utf-8"))
+
+        def _sendPayload(self, code: int, payload: bytes) -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            if query is not None and url.path.startswith("/kpis/"):
+                self._sendPayload(*query(url.path.removeprefix("/kpis/").rstrip("/"), dict(parse_qsl(url.query))))
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            elif self.path == "/status":
+                self._send(200, get_status())
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path == "/trigger":
+                self._send(202, {"triggered": trigger()})
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug(format % args)
+
+    return DaemonHandler
@@ -5,16 +5,34 @@ This module handles all data extraction operations including file listing,
 downloading, and initial data structuring.
 """
 
+import asyncio
 import logging
 import io
+import os
+import shutil
 import polars as pl
 import tqdm
 from supabase import Client as SPClient
 
 from ..models import ETLConfig
+from ..connections import SupabaseIO
+from ..coordination import FileLeaser
+from ..utils import validate_dataframe
 
 logger = logging.getLogger(__name__)
 
+REQUIRED_COLUMNS = ["item_id","id","shop_id","date","price","review"]
+
+
+def isNotFound(error: BaseException) -> bool:
+    """Whether a download failed because the object is gone, e.g. moved by another worker since the listing."""
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 404:
+        return True
+    # storage answers 400 with a not_found error body for missing objects
+    text = f"{error} {getattr(response, 'text', '')}".lower()
+    return "not found" in text or "not_found" in text
+
 
 class DataExtractor:
     """Handles data extraction from Supabase storage."""
@@ -22,6 +40,9 @@ class DataExtractor:
     def __init__(self, sp_client: SPClient, config: ETLConfig) -> None:
         self.sp_client = sp_client
         self.config = config
+        self.io: SupabaseIO|None = None
+        self.leaser: FileLeaser|None = None
+        self.quarantine: list[pl.DataFrame] = []
 
     def listFiles(self)->None:
         """
@@ -49,16 +70,203 @@ class DataExtractor:
         Note : the empty fike in the backet get ignored
         """
 
-        data = pl.DataFrame()
+        frames = []
+        self.config.filesize = []
         logging.info("started reading files")
+        missing = []
         for file in tqdm.tqdm(self.config.files): 
-            response = self.sp_client.storage.from_(self.config.bucket_name).download(f"{self.config.path}/{file}")
+            try:
+                response = self.sp_client.storage.from_(self.config.bucket_name).download(f"{self.config.path}/{file}")
+            except Exception as e:
+                if not isNotFound(e):
+                    raise
+                missing.append(file)
+                continue
             response = response.decode("utf-8")
-            temp_data :pl.DataFrame = pl.read_json(io.StringIO(response))
-            data = pl.concat([data,temp_data],how="horizontal") 
+            temp_data :pl.DataFrame = self.enforceSchema(pl.read_json(io.StringIO(response)))
+            frames.append(temp_data)
             self.config.filesize.append(temp_data.shape[0])
-        return data
+        self.dropMissing(missing)
+        return self.concatFiles(frames)
+
+    def concatFiles(self,frames:list[pl.DataFrame])->pl.DataFrame:
+        """Concatenates the downloaded files, files without any row left (e.g. quarantined) only count in filesize."""
+        frames = [frame for frame in frames if frame.height]
+        return pl.concat(frames,how="vertical_relaxed") if frames else pl.DataFrame()
+
+    def dropMissing(self,missing:list[str])->None:
+        """
+        Forgets the listed files that were gone by download time and releases their leases.
+
+        The listing may be stale, another worker can have processed and moved a file since.
+        """
+        if not missing:
+            return
+        logging.warning(f"{len(missing)} listed files no longer exist, skipping them: {missing}")
+        self.config.files = [file for file in self.config.files if file not in missing]
+        if self.leaser is not None:
+            self.leaser.release(missing)
     
+    async def listFilesAsync(self)->None:
+        """
+        Same as listFiles through the shared async I/O layer, falls back to a thread without it.
+        """
+        if self.io is None:
+            await asyncio.to_thread(self.listFiles)
+            return
+        try:
+            response = await self.io.list(self.config.bucket_name,self.config.path)
+            self.config.files = [res["name"] for res in response if res["name"] != ".emptyFolderPlaceholder"]
+        except Exception as e:
+            logging.error(f"Error listing files in bucket: {e}")
+            self.config.files = []
+
+    async def downloadFilesAsync(self)->pl.DataFrame:
+        """
+        Same as downloadFiles, with every file downloaded concurrently over the shared pool.
+
+        Files are concatenated in listing order so the file bookkeeping stays aligned.
+        """
+        if self.io is None:
+            return await asyncio.to_thread(self.downloadFiles)
+        self.config.filesize = []
+        logging.info("started reading files")
+        responses = await asyncio.gather(*[self.io.download(self.config.bucket_name,f"{self.config.path}/{file}")
+                                           for file in self.config.files],return_exceptions=True)
+        missing = []
+        for file, response in zip(self.config.files,responses):
+            if isinstance(response,BaseException):
+                if not isNotFound(response):
+                    raise response
+                missing.append(file)
+        self.dropMissing(missing)
+        frames = [self.enforceSchema(pl.read_json(io.BytesIO(response)))
+                  for response in responses if not isinstance(response,BaseException)]
+        self.config.filesize = [frame.height for frame in frames]
+        return self.concatFiles(frames)
+
+    def spoolFiles(self)->pl.LazyFrame|None:
+        """
+        Downloads the files one at a time to local parquet files and scans them lazily.
+
+        Only one file is held in memory at a time, so the backlog size is bounded by disk
+        rather than RAM. The average in-memory row size is kept in self.row_bytes to size
+        the processing chunks.
+        """
+        spool_dir = self.config.out_of_core.spool_dir
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        os.makedirs(spool_dir, exist_ok=True)
+        self.config.filesize = []
+        self.row_bytes = 0.0
+        rows = 0
+        logging.info(f"started spooling files to {spool_dir}")
+        missing = []
+        for index, file in enumerate(tqdm.tqdm(self.config.files)):
+            try:
+                response = self.sp_client.storage.from_(self.config.bucket_name).download(f"{self.config.path}/{file}")
+            except Exception as e:
+                if not isNotFound(e):
+                    raise
+                missing.append(file)
+                continue
+            temp_data :pl.DataFrame = self.enforceSchema(pl.read_json(io.BytesIO(response)))
+            self.config.filesize.append(temp_data.shape[0])
+            if temp_data.height:
+                # files without rows left are not spooled, their schema may not match the scan
+                temp_data.write_parquet(os.path.join(spool_dir, f"raw_{index:06d}.parquet"))
+                # running mean of the in-memory row size
+                self.row_bytes = (self.row_bytes * rows + temp_data.estimated_size()) / (rows + temp_data.height)
+                rows += temp_data.height
+            del temp_data
+        self.dropMissing(missing)
+        if not rows:
+            return None
+        return pl.scan_parquet(os.path.join(spool_dir, "raw_*.parquet"))
+
+    def enforceSchema(self,data:pl.DataFrame)->pl.DataFrame:
+        """
+        Casts one downloaded file to compact dtypes, moving the rows that do not fit to self.quarantine.
+
+        shop_id and the user id become Categorical (shared string cache so files concat),
+        item_id UInt32, date pl.Date and price Float32 or Decimal. A row is quarantined,
+        with its original values, when a cast fails, a required value is missing or the
+        price is negative. Files are enforced one at a time so the file sizes used to
+        track processed files only count the rows that go on.
+        """
+        schema = self.config.schema_enforcement
+        if not schema.enabled or data.is_empty():
+            return data
+        price_dtype = pl.Decimal(12,2) if schema.price_dtype == "Decimal" else pl.Float32
+        if not validate_dataframe(data,REQUIRED_COLUMNS):
+            self.quarantine.append(data)
+            # the whole file is quarantined, nothing of its own columns goes on
+            return pl.DataFrame(schema={"item_id":pl.UInt32,"id":pl.Categorical,"shop_id":pl.Categorical,
+                                        "date":pl.Date,"price":price_dtype,"review":pl.String})
+        pl.enable_string_cache()
+
+        price = pl.col("price")
+        if data.schema["price"] == pl.String:
+            # only currency symbols and spaces go, "12,50" or "1,250" must fail the cast instead of turning into 1250
+            price = price.str.replace_all(r"[\p{Sc}\s]","")
+        date = pl.col("date")
+        if data.schema["date"] == pl.String:
+            date = date.str.to_date(format=schema.date_format,strict=False)
+        casted = data.with_columns(
+            pl.col("item_id").cast(pl.UInt32,strict=False),
+            pl.col("id").cast(pl.String).cast(pl.Categorical),
+            pl.col("shop_id").cast(pl.String).cast(pl.Categorical),
+            date.cast(pl.Date,strict=False),
+            price.cast(price_dtype,strict=False),
+        )
+        rejected = casted.select(
+            (pl.any_horizontal([pl.col(col).is_null() for col in REQUIRED_COLUMNS]) | (pl.col("price") < 0)).alias("rejected")
+        )["rejected"]
+        if rejected.any():
+            logging.warning(f"{rejected.sum()} of {data.height} rows quarantined by schema enforcement")
+            self.quarantine.append(data.filter(rejected))
+        return casted.filter(~rejected)
+
+    def takeQuarantine(self)->pl.DataFrame:
+        """Returns and clears the rows quarantined since the last call."""
+        frames, self.quarantine = self.quarantine, []
+        return pl.concat(frames,how="diagonal_relaxed") if frames else pl.DataFrame()
+
+    def downloadGold(self)->pl.DataFrame:
+        """
+        Downloads the most recent LLM labelled files from the gold folder.
+
+        Only the review and sentiment columns are kept, rows without a sentiment are dropped.
+        Rows the pre-classifier labelled itself (label_source classifier) are left out so it
+        never trains on its own predictions; gold files written before label_source existed are kept whole.
+        """
+        gold_path = self.config.cascade.gold_path
+        try:
+            response = (self.sp_client.storage
+                        .from_(self.config.bucket_name)
+                        .list(gold_path,
+                            {"sortBy": {"column": "created_at", "order": "desc"}}
+                            )
+                        )
+            files = [res["name"] for res in response if res["name"].endswith((".json",".ndjson"))]
+        except Exception as e:
+            logging.error(f"Error listing gold files: {e}")
+            return pl.DataFrame()
+
+        frames = []
+        for file in tqdm.tqdm(files[:self.config.cascade.max_gold_files]):
+            try:
+                response = self.sp_client.storage.from_(self.config.bucket_name).download(f"{gold_path}/{file}")
+                if file.endswith(".ndjson"):
+                    temp_data = pl.read_ndjson(io.BytesIO(response))
+                else:
+                    temp_data = pl.read_json(io.StringIO(response.decode("utf-8")))
+                if "label_source" in temp_data.columns:
+                    temp_data = temp_data.filter(pl.col("label_source") == "llm")
+                frames.append(temp_data.select(["review","sentiment"]).drop_nulls())
+            except Exception as e:
+                logging.error(f"Error reading gold file {file}: {e}")
+        return pl.concat(frames) if frames else pl.DataFrame()
+
     def extract(self)->pl.DataFrame:
         """
         extract process it list all files in the bucket , it down,oad them and structer them in dataframe
@@ -3,10 +3,18 @@ import polars as pl
 from supabase import Client as SPClient
 
 from ..models.models_schema import ETLConfig
+from ..coordination import FileLeaser
+from ..utils import merge_kpis, merge_rollup, rescale_kpis, fetch_all
+from ..connections import SupabaseIO, inFilter
+from ..transform.sketches import KPISketches
+from ..extract.data_extractor import isNotFound
 import asyncio
 import datetime
 logger = logging.getLogger(__name__)
 
+CUBE_KEYS = "grain,period_start,shop_id"
+KPI_AVERAGES = {"user_kpis":"average_spent","shop_kpis":"average_profit","date_kpis":"average_profit_per_day"}
+
 
 class DataLoader:
     """
@@ -18,23 +26,63 @@ class DataLoader:
     def __init__(self, sp_client: SPClient, config: ETLConfig) -> None:
         self.sp_client = sp_client
         self.config = config
+        self.leaser: FileLeaser|None = None
+        self.io: SupabaseIO|None = None
+
+    def goldPayload(self,data:pl.DataFrame|str,run_id:str|None=None)->tuple[bytes|str,str]:
+        """
+        Builds the gold file content and name.
 
-    def saveTogold(self,data:pl.DataFrame)->None:
+        data is either a DataFrame, uploaded as JSON bytes, or the path of a spooled NDJSON
+        file from the out-of-core mode, returned as is so the upload streams it from disk.
+        The name ends with run_id when one is given, so uploading the same run again
+        overwrites its file.
+        """
+        suffix = run_id or datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        if isinstance(data,str):
+            return data, f"gold/final_data_{suffix}.ndjson"
+        return data.write_json().encode("utf-8"), f"gold/final_data_{suffix}.json"
+
+    def saveTogold(self,data:pl.DataFrame|str,run_id:str|None=None)->bool:
+        """Uploads the final data to the gold folder, see goldPayload. False when the upload failed."""
+        try:
+            file, filename = self.goldPayload(data,run_id)
+            def upload(content)->None:
+                (self.sp_client
+                        .storage
+                        .from_(self.config.bucket_name)
+                        .upload(path=filename,
+                                file=content,
+                                file_options={"cache-control": "0","upsert":run_id is not None}) # type:ignore
+                        )
+            if isinstance(file,str):
+                # an open file is sent in chunks by the multipart encoder
+                with open(file,"rb") as spooled:
+                    upload(spooled)
+            else:
+                upload(file)
+            logging.info("file uploaded to gold bucket successfully")
+            return True
+        except Exception as e:
+            logging.error(f"Error uploading file to gold bucket: {e}")
+            return False
+            
+    
+    def saveQuarantine(self,data:pl.DataFrame)->None:
+        """Uploads the rows rejected by schema enforcement for later inspection."""
         try:
-            file = data.write_json().encode("utf-8")
-            filename = f"gold/final_data_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            filename = f"{self.config.schema_enforcement.quarantine_path}/rejected_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
             (self.sp_client
                     .storage
                     .from_(self.config.bucket_name)
                     .upload(path=filename,
-                            file=file,
+                            file=data.write_json().encode("utf-8"),
                             file_options={"cache-control": "0","upsert":False}) # type:ignore
                     )
-            logging.info("file uploaded to gold bucket successfully")
+            logging.info(f"{data.height} quarantined rows uploaded to {filename}")
         except Exception as e:
-            logging.error(f"Error uploading file to gold bucket: {e}")
-            
-    
+            logging.error(f"Error uploading quarantined rows: {e}")
+
     def moveFiles(self)->None:   
         files = []
         for file in self.config.file_to_move:
@@ -51,17 +99,288 @@ class DataLoader:
         self.config.file_to_move = files
     
     
-    def UpsertKpis(self,data:pl.DataFrame,table_name:str,col:str)->None:
+    def UpsertKpis(self,data:pl.DataFrame,table_name:str,col:str)->bool:
+        """Upserts the rows into table_name, False when the upsert failed."""
         try:
-            records = data.to_dicts()
+            # dates are sent as ISO strings, the sync client cannot serialise date objects
+            records = data.with_columns(pl.col(pl.Date).cast(pl.String)).to_dicts()
             self.sp_client.from_(table_name).upsert(records,on_conflict=col).execute()
             logging.info(f"inserted/updated {len(records)} records into {table_name} table successfully.")
+            return True
+        except Exception as e:
+            logging.error(f"Exception during upserting KPIs: {e}")
+            return False
+
+
+    def mergeKpis(self,data:pl.DataFrame,table_name:str,col:str)->bool:
+        """
+        Merges the run KPIs with the stored rows before upserting them.
+
+        The read-merge-upsert is serialised between workers with a lease on the table,
+        so concurrent workers add up their partial KPIs instead of overwriting each other.
+        The likeness scores are normalised over the whole table under the same lease, the
+        stored rows whose normalised score moved are updated as well.
+        """
+        try:
+            with self.leaser.exclusive(f"kpi/{table_name}"): # type:ignore
+                keys = data[col].to_list()
+                rows = []
+                for i in range(0,len(keys),500):
+                    rows.extend(self.sp_client.from_(table_name).select("*").in_(col,keys[i:i+500]).execute().data)
+                merged = merge_kpis(data,pl.DataFrame(rows),col,KPI_AVERAGES[table_name])
+                if "likeness_score" not in merged.columns:
+                    return self.UpsertKpis(merged,table_name,col)
+                scores = pl.DataFrame(fetch_all(lambda: (self.sp_client.from_(table_name)
+                                                         .select(f"{col},likeness_score,normalized_likeness_score").order(col))))
+                merged, rescaled = rescale_kpis(merged,scores,col)
+                return self.UpsertKpis(merged,table_name,col) and (rescaled.is_empty() or self.UpsertKpis(rescaled,table_name,col))
+        except Exception as e:
+            logging.error(f"Exception during merging KPIs into {table_name}: {e}")
+            return False
+
+    def mergeCube(self,delta:pl.DataFrame)->bool:
+        """
+        Adds the cube rows of the run to the stored cube table under a table lease.
+
+        With several workers the local cube of each one only sees its own files, the
+        table is then the merged cube.
+        """
+        table = self.config.rollup.table
+        keys = CUBE_KEYS.split(",")
+        measures = [col for col in delta.columns if col not in keys]
+        try:
+            with self.leaser.exclusive(f"kpi/{table}"): # type:ignore
+                periods = delta["period_start"].unique().cast(pl.String).to_list()
+                rows = []
+                for i in range(0,len(periods),500):
+                    # each period matches a row per shop and grain, far more than one response holds
+                    rows.extend(fetch_all(lambda chunk=periods[i:i+500]: (self.sp_client.from_(table).select("*")
+                                                                         .in_("period_start",chunk)
+                                                                         .order("grain").order("period_start").order("shop_id"))))
+                stored = pl.DataFrame(rows)
+                if not stored.is_empty():
+                    stored = stored.with_columns(pl.col("period_start").str.to_date())
+                merged = merge_rollup(stored,delta,keys,measures).join(delta.select(keys),on=keys,how="semi")
+                return self.UpsertKpis(merged,table,CUBE_KEYS)
+        except Exception as e:
+            logging.error(f"Exception during merging the rollup cube into {table}: {e}")
+            return False
+
+    def loadSketches(self)->KPISketches|None:
+        """
+        Downloads the merged sketch state, None before the first run published one.
+
+        Any other error is raised, taking it for a missing state would overwrite the stored one.
+        """
+        try:
+            blob = self.sp_client.storage.from_(self.config.bucket_name).download(self.config.sketches.path)
+        except Exception as e:
+            if isNotFound(e):
+                return None
+            raise
+        return KPISketches.fromBytes(blob)
+
+    def saveSketches(self,sketches:KPISketches)->KPISketches|None:
+        """
+        Merges the sketches of the run into the stored state and uploads it back.
+
+        The read-merge-upload is serialised under a lease when several workers share the state.
+
+        Returns:
+            The merged state, None when the state could not be read or written and nothing was saved
+        """
+        def mergeAndUpload()->KPISketches:
+            stored = self.loadSketches()
+            if stored is not None:
+                stored.merge(sketches)
+            merged = stored or sketches
+            (self.sp_client
+                    .storage
+                    .from_(self.config.bucket_name)
+                    .upload(path=self.config.sketches.path,
+                            file=merged.toBytes(),
+                            file_options={"cache-control": "0","upsert":True}) # type:ignore
+                    )
+            return merged
+        try:
+            if self.leaser is None:
+                return mergeAndUpload()
+            with self.leaser.exclusive("kpi/sketches"):
+                return mergeAndUpload()
+        except Exception as e:
+            logging.error(f"Exception during saving the KPI sketches: {e}")
+            return None
+
+    async def saveTogoldAsync(self,data:pl.DataFrame|str,run_id:str|None=None)->bool:
+        try:
+            file, filename = self.goldPayload(data,run_id)
+            if isinstance(file,str):
+                await self.io.uploadFile(self.config.bucket_name,filename,file,upsert=run_id is not None) # type:ignore
+            else:
+                await self.io.upload(self.config.bucket_name,filename,file,upsert=run_id is not None) # type:ignore
+            logging.info("file uploaded to gold bucket successfully")
+            return True
+        except Exception as e:
+            logging.error(f"Error uploading file to gold bucket: {e}")
+            return False
+
+    async def moveFilesAsync(self)->None:
+        """Moves every processed file concurrently, the failed ones stay in file_to_move."""
+        files = self.config.file_to_move
+        results = await asyncio.gather(*[self.io.move(self.config.bucket_name, # type:ignore
+                                                      f"{self.config.path}/{file}",
+                                                      f"{self.config.destpath}/{file}") for file in files],
+                                       return_exceptions=True)
+        failed = []
+        for file, result in zip(files,results):
+            if isinstance(result,Exception):
+                logging.error(f"Error moving file {file} to processed folder: {result}")
+                failed.append(file)
+        self.config.file_to_move = failed
+
+    async def upsertKpisAsync(self,data:pl.DataFrame,table_name:str,col:str)->bool:
+        try:
+            records = data.with_columns(pl.col(pl.Date).cast(pl.String)).to_dicts()
+            await self.io.upsert(table_name,records,col) # type:ignore
+            logging.info(f"inserted/updated {len(records)} records into {table_name} table successfully.")
+            return True
         except Exception as e:
             logging.error(f"Exception during upserting KPIs: {e}")
+            return False
+
+    async def mergeKpisAsync(self,data:pl.DataFrame,table_name:str,col:str)->bool:
+        """mergeKpis over the async I/O layer, only the lease waits run in a thread."""
+        try:
+            async with self.leaser.exclusiveAsync(f"kpi/{table_name}"): # type:ignore
+                keys = data[col].cast(pl.String).to_list()
+                rows = []
+                for i in range(0,len(keys),500):
+                    rows.extend(await self.io.select(table_name,filters={col: inFilter(keys[i:i+500])},order=col)) # type:ignore
+                merged = merge_kpis(data,pl.DataFrame(rows),col,KPI_AVERAGES[table_name])
+                if "likeness_score" not in merged.columns:
+                    return await self.upsertKpisAsync(merged,table_name,col)
+                scores = pl.DataFrame(await self.io.select(table_name,f"{col},likeness_score,normalized_likeness_score",order=col)) # type:ignore
+                merged, rescaled = rescale_kpis(merged,scores,col)
+                return (await self.upsertKpisAsync(merged,table_name,col)
+                        and (rescaled.is_empty() or await self.upsertKpisAsync(rescaled,table_name,col)))
+        except Exception as e:
+            logging.error(f"Exception during merging KPIs into {table_name}: {e}")
+            return False
+
+    async def mergeCubeAsync(self,delta:pl.DataFrame)->bool:
+        """mergeCube over the async I/O layer, only the lease waits run in a thread."""
+        table = self.config.rollup.table
+        keys = CUBE_KEYS.split(",")
+        measures = [col for col in delta.columns if col not in keys]
+        try:
+            async with self.leaser.exclusiveAsync(f"kpi/{table}"): # type:ignore
+                periods = delta["period_start"].unique().cast(pl.String).to_list()
+                rows = []
+                for i in range(0,len(periods),500):
+                    rows.extend(await self.io.select(table,filters={"period_start": inFilter(periods[i:i+500])}, # type:ignore
+                                                     order=CUBE_KEYS))
+                stored = pl.DataFrame(rows)
+                if not stored.is_empty():
+                    stored = stored.with_columns(pl.col("period_start").str.to_date())
+                merged = merge_rollup(stored,delta,keys,measures).join(delta.select(keys),on=keys,how="semi")
+                return await self.upsertKpisAsync(merged,table,CUBE_KEYS)
+        except Exception as e:
+            logging.error(f"Exception during merging the rollup cube into {table}: {e}")
+            return False
+
+    async def saveQuarantineAsync(self,data:pl.DataFrame)->None:
+        """Uploads the rows rejected by schema enforcement, see saveQuarantine."""
+        if self.io is None:
+            await asyncio.to_thread(self.saveQuarantine,data)
+            return
+        try:
+            filename = f"{self.config.schema_enforcement.quarantine_path}/rejected_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            await self.io.upload(self.config.bucket_name,filename,data.write_json().encode("utf-8"))
+            logging.info(f"{data.height} quarantined rows uploaded to {filename}")
+        except Exception as e:
+            logging.error(f"Error uploading quarantined rows: {e}")
+
+    async def saveSketchesAsync(self,sketches:KPISketches)->KPISketches|None:
+        """Merges the sketches of the run into the stored state, see saveSketches."""
+        if self.io is None:
+            return await asyncio.to_thread(self.saveSketches,sketches)
+        async def mergeAndUpload()->KPISketches:
+            try:
+                stored = KPISketches.fromBytes(await self.io.download(self.config.bucket_name,self.config.sketches.path)) # type:ignore
+                stored.merge(sketches)
+            except Exception as e:
+                if not isNotFound(e):
+                    raise
+                stored = sketches
+            await self.io.upload(self.config.bucket_name,self.config.sketches.path,stored.toBytes(), # type:ignore
+                                 content_type="application/octet-stream",upsert=True)
+            return stored
+        try:
+            if self.leaser is None:
+                return await mergeAndUpload()
+            async with self.leaser.exclusiveAsync("kpi/sketches"):
+                return await mergeAndUpload()
+        except Exception as e:
+            logging.error(f"Exception during saving the KPI sketches: {e}")
+            return None
+
+    async def loadEstimates(self,shop_estimates:pl.DataFrame,user_estimates:pl.DataFrame)->None:
+        """
+        Upserts the sample-based KPI estimates, nothing is moved.
+
+        The rows of the run replace the stored ones, with several workers each key
+        holds the estimate of the last worker that saw it.
+        """
+        tables = [(data,table,col) for data,table,col in ((shop_estimates,self.config.estimation.shop_table,"shop_id"),
+                                                           (user_estimates,self.config.estimation.user_table,"id"))
+                  if not data.is_empty()]
+        if self.io is not None:
+            await asyncio.gather(*[self.upsertKpisAsync(data,table,col) for data,table,col in tables])
+        else:
+            await asyncio.gather(*[asyncio.to_thread(self.UpsertKpis,data,table,col) for data,table,col in tables])
+
+    async def retryMoves(self)->None:
+        """Moves the files an earlier load could not move, left in file_to_move."""
+        if self.io is not None:
+            await self.moveFilesAsync()
+        else:
+            await asyncio.to_thread(self.moveFiles)
+
+    async def load(self,tables:list[tuple[pl.DataFrame,str,str]],final_data:pl.DataFrame|str,
+                   cube:tuple[pl.DataFrame,pl.DataFrame]|None=None,run_id:str|None=None)->bool:
+        """
+        Publishes the KPIs, the gold data and moves the processed files.
 
+        cube is the (run delta, merged touched rows) pair of the rollup stage, the touched
+        rows are upserted as is unless several workers share the cube table. run_id names
+        the gold file of a run that may be loaded more than once, see goldPayload.
+        The files are only moved once every upsert and the gold upload succeeded.
 
-    async def load(self,tables:list[tuple[pl.DataFrame,str,str]],final_data:pl.DataFrame)->None:
-        asyncio_tasks = [asyncio.to_thread(self.UpsertKpis,table[0],table[1],table[2]) for table in tables]
-        await asyncio.gather(*asyncio_tasks)
-        self.saveTogold(final_data)
-        self.moveFiles()
\ No newline at end of file
+        Returns:
+            True if every write succeeded
+        """
+        if self.leaser is not None and not self.leaser.holdsAll():
+            raise RuntimeError("file leases were lost during the run, results are left to the worker that took them over")
+        if cube is not None and not cube[0].is_empty() and self.leaser is None:
+            tables = [*tables,(cube[1],self.config.rollup.table,CUBE_KEYS)]
+        if self.io is not None:
+            upsertAsync = self.upsertKpisAsync if self.leaser is None else self.mergeKpisAsync
+            writes = [upsertAsync(table[0],table[1],table[2]) for table in tables]
+            if cube is not None and not cube[0].is_empty() and self.leaser is not None:
+                writes.append(self.mergeCubeAsync(cube[0]))
+            written = await asyncio.gather(*writes,self.saveTogoldAsync(final_data,run_id))
+            if not all(written):
+                logging.error("the run was not fully written, the processed files are not moved")
+                return False
+            await self.moveFilesAsync()
+            return True
+        upsert = self.UpsertKpis if self.leaser is None else self.mergeKpis
+        asyncio_tasks = [asyncio.to_thread(upsert,table[0],table[1],table[2]) for table in tables]
+        if cube is not None and not cube[0].is_empty() and self.leaser is not None:
+            asyncio_tasks.append(asyncio.to_thread(self.mergeCube,cube[0]))
+        written = await asyncio.gather(*asyncio_tasks)
+        if not (all(written) and self.saveTogold(final_data,run_id)):
+            logging.error("the run was not fully written, the processed files are not moved")
+            return False
+        self.moveFiles()
+        return True
\ No newline at end of file
@@ -5,16 +5,23 @@ This module orchestrates the complete ETL pipeline process, coordinating
 data extraction, transformation, and loading operations.
 """
 
+import argparse
+import datetime
 import logging
 import os
+import uuid
+import polars as pl
 import yaml
 from dotenv import load_dotenv
 from supabase import Client as SPClient
-import os
 from .models import ETLConfig
 from .extract import DataExtractor
-from .transform import DataTransformer
+from .transform import DataTransformer, KPIRollup, KPISketches
 from .load import DataLoader
+from .coordination import FileLeaser, createLeaseStore
+from .connections import SupabaseIO
+from .query_service import KPIQueryService
+from .utils import write_stage, read_stage, write_manifest, read_manifest, StageProfiler
 import asyncio
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -29,40 +36,370 @@ class ETLPipeline:
         self.extractor = DataExtractor(config=config, sp_client=sp_client)
         self.transformer = DataTransformer(config=config)
         self.loader = DataLoader(sp_client=sp_client, config=self.config)
+        self.io: SupabaseIO|None = None
+        if config.io.enabled:
+            # one pooled async client shared by extraction and loading
+            self.io = SupabaseIO(sp_client.supabase_url, sp_client.supabase_key, config.io)
+            self.extractor.io = self.io
+            self.loader.io = self.io
+        self.leaser: FileLeaser|None = None
+        if config.coordination.enabled:
+            self.leaser = FileLeaser(config, createLeaseStore(config, sp_client))
+            self.extractor.leaser = self.leaser
+            self.loader.leaser = self.leaser
+        self.rollup: KPIRollup|None = KPIRollup(config) if config.rollup.enabled else None
+        self.profiler = StageProfiler(config.profiling)
+        self.sketches: KPISketches|None = None
+        # sketches of runs whose save failed, merged into the next save
+        self.unsaved_sketches: KPISketches|None = None
+        if config.sketches.enabled:
+            try:
+                self.sketches = self.loader.loadSketches()
+            except Exception as e:
+                logging.error(f"Error loading the KPI sketches, they are served again after the next save: {e}")
+        self.query_service: KPIQueryService|None = None
+        if config.query.enabled:
+            self.query_service = KPIQueryService(config, sp_client, self.rollup.query if self.rollup is not None else None,
+                                                 self.sketchReport if config.sketches.enabled else None)
+        if config.cascade.enabled and self.transformer.classifier is None:
+            self.transformer.trainClassifier(self.extractor.downloadGold())
+
     def run(self) -> None:
         """Runs the complete ETL pipeline."""
+        async def runAndClose() -> None:
+            try:
+                await self.runAsync()
+            finally:
+                await self.closeAsync()
         try:
-            # Step 1: Extract
-            self.extractor.listFiles()
-            if not self.extractor.config.files:
-                logger.info("No files to process. Exiting pipeline.")
-                return
-            raw_data = self.extractor.downloadFiles()
-            if raw_data.is_empty():
-                logger.info("No data extracted. Exiting pipeline.")
-                return
-            logging.info("extraction process finished")
-            # Step 2: Transform
-            final_data,user_kpis,shop_kpis,date_kpis = self.transformer.transform(raw_data)
-
-            if final_data.is_empty():
+            asyncio.run(runAndClose())
+        except Exception as e:
+            logger.error(f"ETL pipeline failed: {e}")
+
+    async def closeAsync(self) -> None:
+        """Closes the pooled connections, they are bound to the event loop that opened them."""
+        if self.io is not None:
+            await self.io.close()
+
+    async def runAsync(self) -> bool:
+        """
+        Runs the complete ETL pipeline inside the caller's event loop.
+
+        Storage calls go through the shared async I/O layer (or threads without it) so a daemon loop stays responsive.
+        A fraction of the runs is profiled per stage when ETLCONFIG.profiling is enabled.
+        With ETLCONFIG.estimation enabled, KPI estimates from a review sample are published before full labelling.
+        Without full labelling the estimated files are recorded and skipped until a full run moves them.
+
+        Returns:
+            True if new data was processed and published
+        """
+        # Step 1: Extract
+        await self.extractor.listFilesAsync()
+        if self.estimatesOnly():
+            self.config.files = self.unestimated(self.config.files)
+        if self.leaser is not None:
+            # only keep the files this worker holds a lease on
+            self.config.files = await asyncio.to_thread(self.leaser.claim, self.config.files)
+        if not self.extractor.config.files:
+            logger.info("No files to process. Exiting pipeline.")
+            return False
+        self.profiler.begin()
+        try:
+            return await self.processFiles()
+        finally:
+            self.profiler.end()
+            if self.leaser is not None:
+                await asyncio.to_thread(self.leaser.releaseAll)
+
+    async def processFiles(self) -> bool:
+        """Transforms and loads the listed files, see runAsync."""
+        if self.config.out_of_core.enabled:
+            return await self.runOutOfCore()
+        with self.profiler.stage("extract"):
+            raw_data = await self.extractor.downloadFilesAsync()
+            await self.publishQuarantine()
+        if raw_data.is_empty():
+            logger.info("No data extracted. Exiting pipeline.")
+            return False
+        logging.info("extraction process finished")
+        with self.profiler.stage("estimate"):
+            labels = await self.estimateStage(raw_data)
+        if self.estimatesOnly():
+            if labels is None:
+                return False
+            self.markEstimated(self.config.files)
+            logger.info("KPI estimates published, the files are left for a full run.")
+            return True
+        # Step 2: Transform
+        with self.profiler.stage("transform"):
+            final_data,user_kpis,shop_kpis,date_kpis = await self.transformer.transformAsync(raw_data,labels)
+
+        if final_data.is_empty():
+            logger.info("No data after transformation. Exiting pipeline.")
+            return False
+        logging.info("transformation process finished")
+
+        tables = [(user_kpis,"user_kpis","id"),
+                (shop_kpis,"shop_kpis","shop_id"),
+                (date_kpis,"date_kpis","date")]
+
+        with self.profiler.stage("aggregate"):
+            sketches = await self.sketchStage(final_data)
+            cube = await self.rollupStage(final_data)
+        with self.profiler.stage("load"):
+            if not await self.loader.load(tables,final_data,cube):
+                logger.error("The run was not published, its files stay for the next run.")
+                return False
+            await self.published(user_kpis,shop_kpis,date_kpis,sketches)
+        logging.info("loading process finished")
+
+        logger.info("ETL pipeline completed successfully.")
+        return True
+
+    async def estimateStage(self, raw_data: pl.DataFrame) -> pl.DataFrame | None:
+        """
+        Publishes the KPI estimates of a stratified review sample ahead of full labelling.
+
+        Returns:
+            item_id/sentiment labels of the sample, reused by the full labelling, None when estimation is off or failed
+        """
+        if self.transformer.estimator is None:
+            return None
+        shop_estimates,user_estimates,labels = await self.transformer.estimateKpis(raw_data)
+        if labels.is_empty():
+            return None
+        await self.loader.loadEstimates(shop_estimates,user_estimates)
+        logging.info("KPI estimates published")
+        return labels
+
+    def estimatesOnly(self) -> bool:
+        """True when runs only publish estimates and leave the files for a later full run."""
+        estimation = self.config.estimation
+        return estimation.enabled and not estimation.full_labelling and not self.config.out_of_core.enabled
+
+    def unestimated(self, files: list[str]) -> list[str]:
+        """
+        Drops the listed files whose estimates are already published, sampling them again would pay the LLM twice.
+
+        Files no longer listed (moved by a full run) are forgotten by the manifest.
+        """
+        manifest_dir = self.config.estimation.manifest_dir
+        estimated = set(read_manifest(manifest_dir).get("files", []))
+        listed = estimated.intersection(files)
+        if files and listed != estimated:
+            write_manifest(manifest_dir, {"files": sorted(listed)})
+        remaining = [file for file in files if file not in estimated]
+        if len(remaining) < len(files):
+            logger.info(f"{len(files) - len(remaining)} files already estimated, left for a full run")
+        return remaining
+
+    def markEstimated(self, files: list[str]) -> None:
+        """Records the files whose estimates were published, see unestimated."""
+        manifest_dir = self.config.estimation.manifest_dir
+        estimated = set(read_manifest(manifest_dir).get("files", [])).union(files)
+        write_manifest(manifest_dir, {"files": sorted(estimated)})
+
+    async def rollupStage(self, final_data: pl.DataFrame | pl.LazyFrame) -> tuple[pl.DataFrame, pl.DataFrame] | None:
+        """Aggregates the new rows into the KPI cube, returns the (delta, touched rows) pair for the loader."""
+        if self.rollup is None:
+            return None
+        delta = await asyncio.to_thread(self.rollup.aggregate, final_data)
+        return delta, await asyncio.to_thread(self.rollup.update, delta)
+
+    async def sketchStage(self, final_data: pl.DataFrame | pl.LazyFrame, chunk_rows: int | None = None) -> KPISketches | None:
+        """Sketches the rows of the run, merged into the stored state once the run is loaded."""
+        if not self.config.sketches.enabled:
+            return None
+        sketches = KPISketches(self.config.sketches.precision, self.config.sketches.top_k, self.config.sketches.compression)
+        await asyncio.to_thread(sketches.update, final_data, chunk_rows)
+        return sketches
+
+    def sketchReport(self, name: str) -> pl.DataFrame | None:
+        if self.sketches is None:
+            return pl.DataFrame()
+        return self.sketches.report(name)
+
+    async def published(self, user_kpis: pl.DataFrame, shop_kpis: pl.DataFrame, date_kpis: pl.DataFrame,
+                        sketches: KPISketches | None = None) -> None:
+        """Commits the rollup cube, merges the sketches and refreshes the in-memory KPIs once a run is loaded."""
+        if self.rollup is not None:
+            self.rollup.commit()
+        if sketches is not None:
+            if self.unsaved_sketches is not None:
+                sketches.merge(self.unsaved_sketches)
+            merged = await self.loader.saveSketchesAsync(sketches)
+            if merged is None:
+                # the stored state is left untouched, this run is added by the next successful save
+                self.unsaved_sketches = sketches
+            else:
+                self.sketches, self.unsaved_sketches = merged, None
+        if self.query_service is None:
+            return
+        if self.leaser is not None:
+            # the tables hold the KPIs merged with the other workers, reload them
+            await asyncio.to_thread(self.query_service.refresh)
+        else:
+            self.query_service.publish(user_kpis,shop_kpis,date_kpis)
+
+    async def publishQuarantine(self) -> None:
+        quarantine = self.extractor.takeQuarantine()
+        if not quarantine.is_empty():
+            await self.loader.saveQuarantineAsync(quarantine)
+
+    async def runOutOfCore(self) -> bool:
+        """
+        Out-of-core variant of runAsync, files are spooled to disk and processed through lazy scans.
+
+        The rows labelled per chunk and the streaming engine chunk size are derived from
+        ETLCONFIG.out_of_core.memory_budget_mb and the average row size of the spooled files.
+        """
+        with self.profiler.stage("extract"):
+            raw_data = await asyncio.to_thread(self.extractor.spoolFiles)
+            await self.publishQuarantine()
+        if raw_data is None:
+            logger.info("No data extracted. Exiting pipeline.")
+            return False
+        logging.info("extraction process finished")
+        # a quarter of the budget per chunk leaves room for the join and aggregation buffers
+        budget = self.config.out_of_core.memory_budget_mb * 1024 * 1024
+        chunk_rows = max(self.config.batch_size, int(budget / 4 / max(self.extractor.row_bytes, 1.0)))
+        # scoped to this run, a daemon's later in-memory runs keep the default chunk size
+        with pl.Config(streaming_chunk_size=chunk_rows):
+            with self.profiler.stage("transform"):
+                gold_path,user_kpis,shop_kpis,date_kpis = await self.transformer.transformLazy(
+                    raw_data, self.config.out_of_core.spool_dir, chunk_rows)
+            if gold_path is None:
                 logger.info("No data after transformation. Exiting pipeline.")
-                return
+                return False
             logging.info("transformation process finished")
 
             tables = [(user_kpis,"user_kpis","id"),
                     (shop_kpis,"shop_kpis","shop_id"),
                     (date_kpis,"date_kpis","date")]
-            
-            asyncio.run(self.loader.load(tables,final_data))
-            logging.info("loading process finished")
-
+            with self.profiler.stage("aggregate"):
+                sketches = await self.sketchStage(pl.scan_ndjson(gold_path), chunk_rows)
+                cube = await self.rollupStage(pl.scan_ndjson(gold_path))
+            with self.profiler.stage("load"):
+                if not await self.loader.load(tables,gold_path,cube):
+                    logger.error("The run was not published, its files stay for the next run.")
+                    return False
+                await self.published(user_kpis,shop_kpis,date_kpis,sketches)
             logger.info("ETL pipeline completed successfully.")
-        except Exception as e:
-            logger.error(f"ETL pipeline failed: {e}")
+            return True
 
+    def extractStage(self) -> bool:
+        """
+        Runs extraction only and persists the raw data for the transform stage.
 
-if __name__ == "__main__":
+        With coordination enabled the files are leased as in run; the leases are kept after
+        the process exits and taken back by the transform and load stages through the manifest.
+        """
+        self.extractor.listFiles()
+        if self.leaser is not None:
+            self.config.files = self.leaser.claim(self.config.files)
+        if not self.config.files:
+            logger.info("No files to process.")
+            return False
+        raw_data = self.extractor.downloadFiles()
+        quarantine = self.extractor.takeQuarantine()
+        if not quarantine.is_empty():
+            self.loader.saveQuarantine(quarantine)
+        if raw_data.is_empty():
+            if self.leaser is not None:
+                self.leaser.releaseAll()
+            logger.info("No data extracted.")
+            return False
+        write_stage(raw_data, self.config.stage_dir, "raw")
+        manifest = {"files": self.config.files, "filesize": self.config.filesize,
+                    "run_id": f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"}
+        if self.leaser is not None:
+            manifest["worker_id"] = self.leaser.worker_id
+        write_manifest(self.config.stage_dir, manifest)
+        return True
+
+    def resumeLeases(self, manifest: dict) -> bool:
+        """Takes back the file leases of the extract stage, False if another worker took one of them over."""
+        if self.leaser is None:
+            return True
+        if "worker_id" not in manifest:
+            logger.error("coordination is enabled but the extract stage ran without it, rerun the extract stage")
+            return False
+        if not self.leaser.resume(manifest.get("files", []), manifest["worker_id"]):
+            logger.error("file leases of the extract stage were taken over by another worker, rerun the extract stage")
+            return False
+        return True
+
+    def transformStage(self) -> bool:
+        """Runs transformation on the memory-mapped extract output and persists the results for the load stage."""
+        manifest = read_manifest(self.config.stage_dir)
+        if not self.resumeLeases(manifest):
+            return False
+        self.config.files = manifest.get("files", [])
+        self.config.filesize = manifest.get("filesize", [])
+        self.config.file_to_move = []
+        raw_data = read_stage(self.config.stage_dir, "raw")
+        if raw_data.is_empty():
+            logger.info("No data extracted.")
+            return False
+        outputs = self.transformer.transform(raw_data)
+        if outputs[0].is_empty():
+            logger.info("No data after transformation.")
+            return False
+        for name, data in zip(STAGE_OUTPUTS, outputs):
+            write_stage(data, self.config.stage_dir, name)
+        write_manifest(self.config.stage_dir, {**manifest, "file_to_move": self.config.file_to_move})
+        return True
+
+    def loadStage(self) -> bool:
+        """
+        Loads the memory-mapped transform outputs, can be rerun without redoing inference.
+
+        The rollup cube, sketches and query service are updated as in run and the gold file
+        is named after the run, so a rerun overwrites it. The run only counts as published once
+        every upsert and the gold upload succeeded; from then on a rerun only retries the file
+        moves that failed, the merged KPIs, cube and sketches are not added twice.
+
+        Returns:
+            True if the run is published
+        """
+        manifest = read_manifest(self.config.stage_dir)
+        if not self.resumeLeases(manifest):
+            return False
+        self.config.file_to_move = manifest.get("file_to_move", [])
+        final_data, user_kpis, shop_kpis, date_kpis = [read_stage(self.config.stage_dir, name) for name in STAGE_OUTPUTS]
+        tables = [(user_kpis,"user_kpis","id"),
+                (shop_kpis,"shop_kpis","shop_id"),
+                (date_kpis,"date_kpis","date")]
+        async def loadAndClose() -> bool:
+            try:
+                if manifest.get("published"):
+                    await self.loader.retryMoves()
+                    return True
+                sketches = await self.sketchStage(final_data)
+                cube = await self.rollupStage(final_data)
+                if not await self.loader.load(tables,final_data,cube,manifest.get("run_id")):
+                    logger.error("The run was not published, rerun the load stage.")
+                    return False
+                await self.published(user_kpis,shop_kpis,date_kpis,sketches)
+                manifest["published"] = True
+                return True
+            finally:
+                await self.closeAsync()
+                if self.leaser is not None:
+                    self.leaser.releaseAll()
+        try:
+            published = asyncio.run(loadAndClose())
+        finally:
+            # files that failed to move stay in the manifest for the next load
+            write_manifest(self.config.stage_dir, {**manifest, "file_to_move": self.config.file_to_move})
+        logger.info("loading process finished")
+        return published
+
+
+STAGE_OUTPUTS = ["final_data", "user_kpis", "shop_kpis", "date_kpis"]
+
+
+def createClient() -> SPClient:
     path = "/home/aymen/Desktop/my_work/data_engineer/.env"
     path = path if os.path.exists(path) else "/app/.env"
     if not os.path.exists(path):
@@ -72,15 +409,49 @@ if __name__ == "__main__":
     key:str|None = os.getenv("project_key")
     if not url or not key:
         raise ValueError("Supabase URL or Key not found in environment variables.")
-    
-    sp_client:SPClient = SPClient(url,key)
+    return SPClient(url,key)
+
+
+def loadConfig() -> ETLConfig:
     # Load configuration from YAML file
     config_path =  "/home/aymen/Desktop/my_work/data_engineer/config.yaml"
     config_path = config_path if os.path.exists(config_path) else "./config.yaml"
 
     with open(config_path, "r") as file:
         config_dict = yaml.safe_load(file)
-    
-    config = ETLConfig(**config_dict["ETLCONFIG"])
-    etl_pipeline = ETLPipeline(config=config, sp_client=sp_client)
-    etl_pipeline.run()
\ No newline at end of file
+    return ETLConfig(**config_dict["ETLCONFIG"])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="etl_pipeline", description="E-commerce analytics ETL pipeline")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="run extract, transform and load once (default)")
+    subparsers.add_parser("estimate", help="publish KPI estimates from a sample of the reviews, the files stay for a full run")
+    subparsers.add_parser("daemon", help="keep the pipeline warm, poll for new files and serve trigger/status endpoints")
+    for stage in ("extract", "transform", "load"):
+        stage_parser = subparsers.add_parser(stage, help=f"run the {stage} stage only, handing data over as Arrow IPC")
+        stage_parser.add_argument("--stage-dir", help="override ETLCONFIG.stage_dir")
+    args = parser.parse_args()
+
+    config = loadConfig()
+    if args.command == "estimate":
+        config.estimation.enabled = True
+        config.estimation.full_labelling = False
+    if getattr(args, "stage_dir", None):
+        config.stage_dir = args.stage_dir
+    etl_pipeline = ETLPipeline(config=config, sp_client=createClient())
+    if args.command == "daemon":
+        from .daemon import ETLDaemon
+        ETLDaemon(etl_pipeline).serve()
+    elif args.command == "extract":
+        etl_pipeline.extractStage()
+    elif args.command == "transform":
+        etl_pipeline.transformStage()
+    elif args.command == "load":
+        etl_pipeline.loadStage()
+    else:
+        etl_pipeline.run()
+
+
+if __name__ == "__main__":
+    main()
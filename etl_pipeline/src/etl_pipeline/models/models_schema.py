@@ -22,6 +22,150 @@ class Response(BaseModel):
     )
 
 
+class EndpointConfig(BaseModel):
+    """Configuration model for a single OpenAI-compatible LLM server."""
+    base_url: str
+    weight: float = Field(default=1.0, gt=0, description="Relative share of traffic sent to this endpoint")
+    slots: int = Field(default=4, ge=1, description="Parallel slots served by the endpoint (llama.cpp --parallel)")
+    model: str | None = Field(default=None, description="Model name override, defaults to ETLConfig.model")
+
+
+class RouterConfig(BaseModel):
+    """Configuration model for the multi-endpoint LLM router."""
+    endpoints: List[EndpointConfig] = Field(default_factory=list, description="Pool of endpoints, falls back to base_url when empty")
+    strategy: str = Field(default="least_outstanding", pattern="^(least_outstanding|latency)$", description="Dispatch strategy")
+    max_failures: int = Field(default=3, ge=1, description="Consecutive failures before an endpoint is ejected")
+    cooldown: float = Field(default=30.0, ge=0, description="Seconds an ejected endpoint waits before a health probe")
+    max_attempts: int = Field(default=3, ge=1, description="Endpoints a failed request is tried on before its error is returned")
+    latency_alpha: float = Field(default=0.2, gt=0, le=1, description="Smoothing factor of the latency moving average")
+    hedging: bool = Field(default=False, description="Duplicate requests that run past the latency deadline")
+    hedge_percentile: float = Field(default=95.0, gt=0, lt=100, description="Percentile of recent latencies used as hedge deadline")
+    hedge_budget: float = Field(default=0.1, ge=0, le=1, description="Maximum share of extra requests sent as hedges")
+    hedge_min_samples: int = Field(default=20, ge=1, description="Latencies needed before hedging starts")
+    latency_window: int = Field(default=200, ge=1, description="Number of recent latencies kept for the deadline")
+
+
+class CascadeConfig(BaseModel):
+    """Configuration model for the CPU pre-classifier cascade."""
+    enabled: bool = Field(default=False, description="Label confident reviews on CPU before calling the LLM")
+    threshold: float = Field(default=0.9, gt=0.5, lt=1, description="Minimum class probability to skip the LLM")
+    audit_rate: float = Field(default=0.02, ge=0, le=1, description="Share of confident reviews still sent to the LLM to measure agreement")
+    model_path: str = Field(default="models/pre_classifier.npz", description="Where the trained classifier is stored")
+    gold_path: str = Field(default="gold", description="Bucket folder holding LLM labelled data used for training")
+    max_gold_files: int = Field(default=20, ge=1, description="Most recent gold files used for training")
+    min_training_rows: int = Field(default=1000, ge=1, description="Cascade stays off below this many labelled reviews")
+
+
+class DaemonConfig(BaseModel):
+    """Configuration model for the long-running ETL daemon."""
+    poll_interval: float = Field(default=30.0, gt=0, description="Seconds between two polls of the to_process folder")
+    host: str = Field(default="0.0.0.0", description="Address of the trigger/status HTTP server")
+    port: int = Field(default=5000, description="Port of the trigger/status HTTP server")
+
+
+class OutOfCoreConfig(BaseModel):
+    """Configuration model for the out-of-core (spooled, streaming) mode."""
+    enabled: bool = Field(default=False, description="Spool downloads to disk and process them with lazy scans")
+    spool_dir: str = Field(default="output/spool", description="Local directory for spooled files")
+    memory_budget_mb: int = Field(default=1024, ge=64, description="Peak memory the pipeline should stay under")
+
+
+class CoordinationConfig(BaseModel):
+    """Configuration model for lease-based file sharding between workers."""
+    enabled: bool = Field(default=False, description="Claim files through leases so several workers can run")
+    store: str = Field(default="sqlite", pattern="^(sqlite|storage|table)$", description="Lease backend")
+    worker_id: str | None = Field(default=None, description="Defaults to hostname-pid")
+    lease_ttl: float = Field(default=300.0, gt=0, description="Seconds a lease stays valid without a heartbeat")
+    heartbeat_interval: float = Field(default=60.0, gt=0, description="Seconds between two lease renewals")
+    max_files: int = Field(default=10, ge=1, description="Files claimed by a worker per run")
+    sqlite_path: str = Field(default="output/leases.db", description="Database of the sqlite lease store")
+    lease_prefix: str = Field(default="leases", description="Bucket folder of the storage lease markers")
+    lease_table: str = Field(default="etl_leases", description="Table of the table lease store")
+
+
+class CompactResponse(BaseModel):
+    """Model for the compact positional response, one T/F letter per review in prompt order."""
+    labels: str = Field(
+        description="One letter per review, in the order of the reviews. T: positive, F: negative",
+        pattern="^[TF]+$"
+    )
+
+    @classmethod
+    def schemaFor(cls, size: int) -> dict:
+        """JSON schema pinned to exactly size labels, so the grammar cannot under or over generate."""
+        schema = cls.model_json_schema()
+        schema["properties"]["labels"].update(minLength=size, maxLength=size, pattern=f"^[TF]{{{size}}}$")
+        return schema
+
+
+COMPACT_SYSTEM_PROMPT = """You are given a numbered list of product reviews.
+Classify each review as positive (T) or negative (F).
+Return a JSON object {"labels": "<letters>"} with exactly one letter per review, in the same order as the reviews."""
+
+
+class IOConfig(BaseModel):
+    """Configuration model for the shared async Supabase I/O layer."""
+    enabled: bool = Field(default=True, description="Use the pooled async client for storage and table calls")
+    max_connections: int = Field(default=20, ge=1, description="Maximum open connections to the Supabase host")
+    max_keepalive_connections: int = Field(default=10, ge=0, description="Idle connections kept alive between calls")
+    http2: bool = Field(default=True, description="Negotiate HTTP/2 when the h2 package is installed")
+    timeout: float = Field(default=60.0, gt=0, description="Seconds before a storage or table call times out")
+
+
+class SchemaConfig(BaseModel):
+    """Configuration model for the dtype enforcement done at extraction time."""
+    enabled: bool = Field(default=False, description="Cast extracted columns to compact dtypes and quarantine bad rows")
+    date_format: str | None = Field(default=None, description="strptime format of the date column, inferred when empty")
+    price_dtype: str = Field(default="Float32", pattern="^(Float32|Decimal)$", description="Float32, or Decimal(12, 2) for exact sums")
+    quarantine_path: str = Field(default="quarantine", description="Bucket folder receiving the rejected rows")
+
+
+class RollupConfig(BaseModel):
+    """Configuration model for the materialized day/week/month KPI cube."""
+    enabled: bool = Field(default=False, description="Maintain the rollup cube from the rows of every run")
+    cube_path: str = Field(default="output/kpi_cube.parquet", description="Local parquet copy of the cube")
+    table: str = Field(default="kpi_cube", description="Table receiving the touched cube rows")
+
+
+class QueryConfig(BaseModel):
+    """Configuration model for the in-memory KPI read API served by the daemon."""
+    enabled: bool = Field(default=False, description="Mirror the KPI tables in memory and serve /kpis queries")
+    cache_size: int = Field(default=1024, ge=1, description="Query results kept in the LRU cache between two runs")
+    top_k: int = Field(default=10, ge=1, description="Shops returned by /kpis/shops/top when k is not given")
+
+
+class SketchConfig(BaseModel):
+    """Configuration model for the mergeable approximate KPI sketches."""
+    enabled: bool = Field(default=False, description="Maintain HyperLogLog, heavy hitter and t-digest sketches of the reviews")
+    precision: int = Field(default=10, ge=4, le=16, description="HyperLogLog precision, 2^precision bytes per shop, about 1.04/sqrt(2^precision) error")
+    top_k: int = Field(default=100, ge=1, description="Counters of the top shop and top user summaries")
+    compression: float = Field(default=200, gt=0, description="t-digest compression, about compression/2 centroids")
+    path: str = Field(default="sketches/kpi_sketches.npz", description="Bucket path of the merged sketch state")
+
+
+class ProfilingConfig(BaseModel):
+    """Configuration model for the sampled per-stage profiling."""
+    enabled: bool = Field(default=False, description="Profile a fraction of the runs")
+    sample_rate: float = Field(default=0.05, ge=0, le=1, description="Fraction of runs profiled")
+    interval: float = Field(default=0.01, gt=0, description="Seconds between two RSS/stack samples")
+    tracemalloc: bool = Field(default=True, description="Trace Python allocations of profiled runs")
+    traceback_frames: int = Field(default=1, ge=1, description="Frames kept per traced allocation")
+    top_allocations: int = Field(default=10, ge=1, description="Allocation sites reported per stage")
+    output_dir: str = Field(default="output/profiles", description="Directory receiving one folder per profiled run")
+
+
+class EstimationConfig(BaseModel):
+    """Configuration model for the sample-based shop and user KPI estimates."""
+    enabled: bool = Field(default=False, description="Publish KPI estimates from a stratified sample of the reviews before full labelling")
+    confidence: float = Field(default=0.95, gt=0, lt=1, description="Confidence level of the positive rate intervals")
+    margin: float = Field(default=0.1, gt=0, le=0.5, description="Target half width of the positive rate interval per shop")
+    user_margin: float | None = Field(default=None, gt=0, le=0.5, description="Target half width of the positive rate interval per user, empty to only sample shops, users have few reviews each so any margin labels most of them")
+    full_labelling: bool = Field(default=True, description="Label the remaining reviews in the same run, otherwise the files stay for a later full run")
+    manifest_dir: str = Field(default="output/estimation", description="Directory of the manifest listing the files already estimated without full labelling")
+    shop_table: str = Field(default="shop_kpi_estimates", description="Table receiving the shop estimates, keyed by shop_id")
+    user_table: str = Field(default="user_kpi_estimates", description="Table receiving the user estimates, keyed by id")
+
+
 class ETLConfig(BaseModel):
     """Configuration model for ETL pipeline."""
     bucket_name: str
@@ -34,6 +178,22 @@ class ETLConfig(BaseModel):
     system_prompt: str
     base_url: str
     destpath: str
+    output_mode: str = Field(default="objects", pattern="^(objects|compact)$", description="objects: item_id/sentiment list, compact: positional T/F string")
+    compact_system_prompt: str = Field(default=COMPACT_SYSTEM_PROMPT, description="System prompt of the compact output mode")
+    streaming: bool = Field(default=False, description="Stream completions and stop them once every item_id arrived")
+    router: RouterConfig = Field(default_factory=RouterConfig, description="LLM endpoint pool settings")
+    cascade: CascadeConfig = Field(default_factory=CascadeConfig, description="CPU pre-classifier settings")
+    daemon: DaemonConfig = Field(default_factory=DaemonConfig, description="Daemon mode settings")
+    out_of_core: OutOfCoreConfig = Field(default_factory=OutOfCoreConfig, description="Out-of-core mode settings")
+    coordination: CoordinationConfig = Field(default_factory=CoordinationConfig, description="Multi-worker settings")
+    schema_enforcement: SchemaConfig = Field(default_factory=SchemaConfig, description="Extraction dtype enforcement settings")
+    io: IOConfig = Field(default_factory=IOConfig, description="Async Supabase I/O settings")
+    rollup: RollupConfig = Field(default_factory=RollupConfig, description="KPI rollup cube settings")
+    query: QueryConfig = Field(default_factory=QueryConfig, description="KPI read API settings")
+    sketches: SketchConfig = Field(default_factory=SketchConfig, description="Approximate KPI sketch settings")
+    profiling: ProfilingConfig = Field(default_factory=ProfilingConfig, description="Per-stage profiling settings")
+    estimation: EstimationConfig = Field(default_factory=EstimationConfig, description="Sample-based KPI estimate settings")
+    stage_dir: str = Field(default="output/stages", description="Directory of the Arrow IPC handoff between CLI stages")
 
 
 class KPIResult(BaseModel):
@@ -0,0 +1,212 @@
+"""
+In-memory KPI read API.
+
+This module mirrors the KPI tables (and the rollup cube when enabled) in memory
+and answers dashboard queries from them. Serialised query results are kept in an
+LRU-bounded cache that is cleared every time a run publishes, so repeated reads
+are dictionary lookups and never reach the database.
+"""
+
+import datetime
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+import polars as pl
+from supabase import Client as SPClient
+
+from .models import ETLConfig
+from .transform.rollup import query_cube
+from .utils import fetch_all, min_max_normalize
+
+logger = logging.getLogger(__name__)
+
+KPI_TABLES = {"user_kpis": "id", "shop_kpis": "shop_id", "date_kpis": "date"}
+
+
+class KPIQueryService:
+    """Keeps the KPI frames in memory and serves cached query results."""
+
+    def __init__(self, config: ETLConfig, sp_client: SPClient, cube: Callable[..., pl.DataFrame] | None = None,
+                 sketches: Callable[[str], pl.DataFrame | None] | None = None) -> None:
+        self.config = config.query
+        self.sp_client = sp_client
+        self.cube = cube
+        # a coordinated worker's local cube only holds its own files, the table is the merged cube
+        self.cube_table = config.rollup.table if config.rollup.enabled and config.coordination.enabled else None
+        self.sketches = sketches
+        self.frames: dict[str, pl.DataFrame] = {table: pl.DataFrame() for table in KPI_TABLES}
+        if self.cube_table is not None:
+            self.frames[self.cube_table] = pl.DataFrame()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """Loads the KPI tables once, at start up or after coordinated workers merged their runs."""
+        frames = {}
+        for table in KPI_TABLES:
+            try:
+                # paged, a single select stops at the PostgREST max-rows
+                rows = fetch_all(lambda table=table: self.sp_client.from_(table).select("*").order(KPI_TABLES[table]))
+                frames[table] = self._normalise(pl.DataFrame(rows), table)
+            except Exception as e:
+                logging.error(f"Error loading {table} into the query service: {e}")
+                frames[table] = self.frames[table]
+        if self.cube_table is not None:
+            frames[self.cube_table] = self._loadCube()
+        with self._lock:
+            self.frames = self._rescale(frames)
+            self._invalidate()
+        logger.info(f"query service loaded {', '.join(f'{t}: {f.height} rows' for t, f in frames.items())}")
+
+    def _loadCube(self) -> pl.DataFrame:
+        """Reads the merged cube table, the loaded cube is kept when the read fails."""
+        try:
+            rows = fetch_all(lambda: (self.sp_client.from_(self.cube_table).select("*") # type:ignore
+                                      .order("grain").order("period_start").order("shop_id")))
+        except Exception as e:
+            logging.error(f"Error loading {self.cube_table} into the query service: {e}")
+            return self.frames[self.cube_table] # type:ignore
+        cube = pl.DataFrame(rows)
+        if cube.is_empty():
+            return cube
+        return cube.with_columns(pl.col("period_start").str.to_date(), pl.col("shop_id").cast(pl.String))
+
+    def publish(self, user_kpis: pl.DataFrame, shop_kpis: pl.DataFrame, date_kpis: pl.DataFrame) -> None:
+        """
+        Applies the KPIs of a published run the way the upsert does and invalidates the cache.
+
+        Args:
+            user_kpis: Rows upserted into user_kpis
+            shop_kpis: Rows upserted into shop_kpis
+            date_kpis: Rows upserted into date_kpis
+        """
+        with self._lock:
+            for table, data in zip(KPI_TABLES, (user_kpis, shop_kpis, date_kpis)):
+                if data.is_empty():
+                    continue
+                key = KPI_TABLES[table]
+                data = self._normalise(data, table)
+                stored = self.frames[table]
+                if stored.is_empty():
+                    self.frames[table] = data
+                else:
+                    kept = stored.filter(~pl.col(key).is_in(data[key].implode()))
+                    self.frames[table] = pl.concat([kept, data], how="diagonal_relaxed")
+            self.frames = self._rescale(self.frames)
+            self._invalidate()
+
+    def _rescale(self, frames: dict[str, pl.DataFrame]) -> dict[str, pl.DataFrame]:
+        """
+        Normalises the likeness scores over every stored key.
+
+        An uncoordinated run only normalises the keys it touched, so the stored
+        normalized_likeness_score values are not on one scale.
+        """
+        rescaled = dict(frames)
+        for table in ("user_kpis", "shop_kpis"):
+            data = frames[table]
+            if "likeness_score" in data.columns and data["likeness_score"].drop_nulls().len():
+                rescaled[table] = min_max_normalize(data, column="likeness_score", new_column="normalized_likeness_score")
+        return rescaled
+
+    def _normalise(self, data: pl.DataFrame, table: str) -> pl.DataFrame:
+        # keys are compared as strings whatever the extraction dtypes were
+        if data.is_empty():
+            return data
+        key = KPI_TABLES[table]
+        if table == "date_kpis":
+            return data.with_columns(pl.col(key).cast(pl.String).str.slice(0, 10))
+        return data.with_columns(pl.col(key).cast(pl.String))
+
+    def _invalidate(self) -> None:
+        self._cache.clear()
+        self.version += 1
+
+    def query(self, route: str, params: dict[str, str]) -> tuple[int, bytes]:
+        """
+        Answers a read request, from the cache when the same query was already served since the last run.
+
+        Args:
+            route: shops/top, users/<id>, dates, cube or sketches/<name>
+            params: Query string parameters
+
+        Returns:
+            HTTP status code and JSON payload
+        """
+        cache_key = (route, tuple(sorted(params.items())))
+        with self._lock:
+            payload = self._cache.get(cache_key)
+            if payload is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return 200, payload
+            self.misses += 1
+            frames = self.frames
+            version = self.version
+        try:
+            result = self._answer(route, params, frames)
+        except ValueError as e:
+            return 400, json.dumps({"error": str(e)}).encode("utf-8")
+        except Exception as e:
+            logging.error(f"Error answering KPI query {route}: {e}")
+            return 500, json.dumps({"error": str(e)}).encode("utf-8")
+        if result is None:
+            return 404, json.dumps({"error": f"unknown query {route}"}).encode("utf-8")
+        payload = json.dumps({"rows": result.to_dicts()}, default=str).encode("utf-8")
+        with self._lock:
+            # a run published while answering, do not cache a stale result
+            if version == self.version:
+                self._cache[cache_key] = payload
+                if len(self._cache) > self.config.cache_size:
+                    self._cache.popitem(last=False)
+        return 200, payload
+
+    def _answer(self, route: str, params: dict[str, str], frames: dict[str, pl.DataFrame]) -> pl.DataFrame | None:
+        if route == "shops/top":
+            k = int(params.get("k", self.config.top_k))
+            shops = frames["shop_kpis"]
+            if shops.is_empty():
+                return shops
+            return shops.sort("normalized_likeness_score", descending=True, nulls_last=True).head(k)
+        if route.startswith("users/"):
+            users = frames["user_kpis"]
+            if users.is_empty():
+                return users
+            return users.filter(pl.col("id") == route.removeprefix("users/"))
+        if route == "dates":
+            dates = frames["date_kpis"]
+            if dates.is_empty():
+                return dates
+            if "start" in params:
+                dates = dates.filter(pl.col("date") >= _parseDate(params["start"]).isoformat())
+            if "end" in params:
+                dates = dates.filter(pl.col("date") <= _parseDate(params["end"]).isoformat())
+            return dates.sort("date")
+        if route == "cube" and (self.cube is not None or self.cube_table is not None):
+            start = _parseDate(params["start"]) if "start" in params else None
+            end = _parseDate(params["end"]) if "end" in params else None
+            shop_ids = params["shop_id"].split(",") if params.get("shop_id") else None
+            if self.cube_table is not None:
+                return query_cube(frames[self.cube_table], params.get("grain", "day"), start, end, shop_ids)
+            return self.cube(params.get("grain", "day"), start, end, shop_ids)
+        if route.startswith("sketches/") and self.sketches is not None:
+            return self.sketches(route.removeprefix("sketches/"))
+        return None
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"version": self.version, "cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+                    **{table: frame.height for table, frame in self.frames.items()}}
+
+
+def _parseDate(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        raise ValueError(f"invalid date {value!r}, expected YYYY-MM-DD")
@@ -1 +1,5 @@
-from data_transformer import DataTransformer
\ No newline at end of file
+from .data_transformer import DataTransformer
+from .llm_router import LLMRouter, LLMEndpoint
+from .rollup import KPIRollup
+from .sketches import KPISketches
+from .kpi_estimator import KPIEstimator
@@ -7,55 +7,197 @@ KPI generation, and data enrichment.
 
 import logging
 import json
+import os
 from typing import Any
 import asyncio
+import numpy as np
 import polars as pl
-from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletion
-from ..models import Response, ETLConfig
-from ..utils import create_batches, generate_prompt, min_max_normalize
+from ..models import Response, CompactResponse, ETLConfig
+from .llm_router import LLMRouter, LLMEndpoint
+from .pre_classifier import PreClassifier
+from .stream_parser import SentimentStreamParser
+from .kpi_estimator import KPIEstimator
+from ..utils import create_batches, generate_prompt, generate_compact_prompt, min_max_normalize
 from tqdm import tqdm
 logger = logging.getLogger(__name__)
 
+# label_source tells the LLM labels from the pre-classifier ones, only the former train the cascade
+LABEL_COLUMNS = ["item_id","sentiment","label_source"]
+
 
 class DataTransformer:
     """Handles data transformation including sentiment analysis and KPI generation."""
 
     def __init__(self, config: ETLConfig) -> None:
-        self.client = AsyncOpenAI(base_url=config.base_url,api_key="key")
+        self.router = LLMRouter(config)
         self.config = config
+        self.classifier: PreClassifier|None = None
+        self.predictions = pl.DataFrame()
+        self.cascade_stats: dict = {}
+        self.engine = "auto"
+        self.estimator: KPIEstimator|None = KPIEstimator(config) if config.estimation.enabled else None
+        if config.cascade.enabled and os.path.exists(config.cascade.model_path):
+            self.classifier = PreClassifier.load(config.cascade.model_path)
+            logging.info(f"pre-classifier loaded from {config.cascade.model_path}")
+
+    def chatMessages(self,batch_prompt:str)->list[dict]:
+        return [
+            {
+                "role": "system",
+                "content": self.config.system_prompt,
+            },
+            {
+                "role": "user",
+                "content": batch_prompt
+            }
+        ]
+
+    def responseFormat(self)->dict:
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "sentiment_analysis_response",
+                "description": "Response containing sentiment analysis for product reviews",
+                "schema": Response.model_json_schema(),
+                "strict": True
+            }
+        }
+
     async def generateSentiments(self,batch_prompt:str)-> ChatCompletion|Exception:
+        async def request(endpoint:LLMEndpoint)->ChatCompletion:
+            return await endpoint.client.chat.completions.create(
+                messages=self.chatMessages(batch_prompt), # type:ignore
+                model=endpoint.model,
+                response_format=self.responseFormat(), # type:ignore
+                timeout=60
+            )
         try:
-            response = await self.client.chat.completions.create(
+            return await self.router.dispatch(request,self.isValidResponse)
+        except Exception as e:
+            return e
+
+    async def streamSentiments(self,batch:list[dict])->list[dict]|Exception:
+        """
+        Streams the completion and parses sentiments as they arrive.
+
+        The stream is closed as soon as every expected id arrived, the array was closed
+        or the output diverged from the schema (repetition loop, runaway text), which
+        frees the server slot instead of waiting for the timeout. Sentiments parsed
+        before an abort or a stream error (timeout, dropped connection) are kept and only
+        the missing reviews are asked again, for at most router.max_attempts rounds.
+        """
+        items:list[dict] = []
+        missing = batch
+        for _ in range(self.router.config.max_attempts):
+            parsed = await self.streamRound(generate_prompt(missing),[item["item_id"] for item in missing])
+            if isinstance(parsed, Exception):
+                if not items:
+                    return parsed
+                logging.error(f"Error while asking the missing sentiments again: {parsed}")
+                break
+            items.extend(parsed)
+            answered = {item["item_id"] for item in items}
+            missing = [item for item in batch if item["item_id"] not in answered]
+            if not missing or not parsed:
+                break
+        return items
+
+    async def streamRound(self,batch_prompt:str,expected_ids:list[int])->list[dict]|Exception:
+        """One streamed request of streamSentiments, the items parsed so far survive a stream error."""
+        async def request(endpoint:LLMEndpoint)->list[dict]:
+            parser = SentimentStreamParser(expected_ids)
+            stream = await endpoint.client.chat.completions.create(
+                messages=self.chatMessages(batch_prompt), # type:ignore
+                model=endpoint.model,
+                response_format=self.responseFormat(), # type:ignore
+                stream=True,
+                timeout=60
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parser.feed(chunk.choices[0].delta.content)
+                    if parser.done or parser.diverged:
+                        break
+            except Exception as e:
+                if not parser.items:
+                    raise
+                logging.warning(f"stream failed after {len(parser.items)} of {len(expected_ids)} sentiments: {e}")
+            finally:
+                await stream.close()
+            return parser.items
+        try:
+            return await self.router.dispatch(request,lambda items: len(items) == len(expected_ids))
+        except Exception as e:
+            return e
+
+    async def compactSentiments(self,batch:list[dict])->list[dict]|None|Exception:
+        """
+        Asks for one T/F letter per review instead of an item_id/sentiment object each.
+
+        The schema pins the string to the batch length and max_tokens bounds the
+        generation, the letters are mapped back to item_ids by position.
+        """
+        async def request(endpoint:LLMEndpoint)->list[dict]|None:
+            response = await endpoint.client.chat.completions.create(
                 messages=[
-                    {
-                        "role": "system",
-                        "content": self.config.system_prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": batch_prompt
-                    }
+                    {"role": "system", "content": self.config.compact_system_prompt},
+                    {"role": "user", "content": generate_compact_prompt(batch)}
                 ],
-                model=self.config.model,
+                model=endpoint.model,
                 response_format={
                     "type": "json_schema",
                     "json_schema": {
-                        "name": "sentiment_analysis_response",
-                        "description": "Response containing sentiment analysis for product reviews",
-                        "schema": Response.model_json_schema(),
+                        "name": "compact_sentiment_response",
+                        "description": "One T/F letter per review, in prompt order",
+                        "schema": CompactResponse.schemaFor(len(batch)),
                         "strict": True
                     }
-                },
+                }, # type:ignore
+                max_tokens=len(batch) + 16,
                 timeout=60
             )
-            return response
+            return self.parseCompactResponse(response.choices[0].message.content or "",batch)
+        try:
+            return await self.router.dispatch(request,lambda items: items is not None)
         except Exception as e:
             return e
 
-    async def sentimentAnaysisWorkflow(self,batch:list[dict])->str|None:
-        batch_prompt = generate_prompt(batch)
-        response = await self.generateSentiments(batch_prompt)
+    def parseCompactResponse(self,content:str,batch:list[dict])->list[dict]|None:
+        """Validates the T/F string length against the batch and maps positions back to item_ids."""
+        try:
+            labels = CompactResponse.model_validate_json(content).labels
+        except Exception as e:
+            logging.error(f"An error occurred while parsing the compact model response: {e}")
+            return None
+        if len(labels) != len(batch):
+            logging.error(f"compact response has {len(labels)} labels for {len(batch)} reviews")
+            return None
+        return [{"item_id": item["item_id"], "sentiment": label == "T"} for item, label in zip(batch,labels)]
+
+    def isValidResponse(self,response:ChatCompletion)->bool:
+        """Whether a completion parses into Response, used to pick the winner of a hedged request."""
+        try:
+            Response.model_validate_json(response.choices[0].message.content or "")
+            return True
+        except Exception:
+            return False
+
+    async def sentimentAnaysisWorkflow(self,batch:list[dict])->str|list[dict]|None:
+        if self.config.output_mode == "compact":
+            items = await self.compactSentiments(batch)
+            if isinstance(items, Exception):
+                logging.error(f"Error during sentiment analysis: {items}")
+                return None
+            return items
+        if self.config.streaming:
+            items = await self.streamSentiments(batch)
+            if isinstance(items, Exception):
+                logging.error(f"Error during sentiment analysis: {items}")
+                return None
+            return items
+        response = await self.generateSentiments(generate_prompt(batch))
         if isinstance(response, Exception):
             logging.error(f"Error during sentiment analysis: {response}")
             return None
@@ -74,8 +216,8 @@ class DataTransformer:
             logging.error(f"An error occurred while parsing the model response: {e}")
             return None
                 
-    def calculate_file_state(self,nb_batch:int,index:int)->int:
-        total_items = nb_batch * self.config.batch_size
+    def calculate_file_state(self,nb_batch:int,index:int,skipped_items:int=0)->int:
+        total_items = nb_batch * self.config.batch_size + skipped_items
         while total_items>0 and index < len(self.config.files):
             if self.config.filesize[index]>total_items:
                 self.config.filesize[index] -= total_items
@@ -88,33 +230,109 @@ class DataTransformer:
         return index
     
 
-    async def sentmentAnalysis(self, batchs, concurrency: int = 4) -> list[dict]:
-        analysis = []
+    async def sentmentAnalysis(self, batchs, concurrency: int|None = None, skipped_items: int = 0) -> list[dict]:
+        # every slot of the endpoint pool takes the next batch as soon as it frees up,
+        # so a fast endpoint never waits for the slow one and throughput adds up across servers
+        concurrency = concurrency or self.router.capacity
         nb_batchs = len(batchs)
-        index = 0
-        for i in tqdm(range(0, nb_batchs, concurrency),unit="batch",unit_scale=concurrency):
-            index = self.calculate_file_state(nb_batchs,index)
-            contents:list[str|None] = await asyncio.gather(*[self.sentimentAnaysisWorkflow(batch) for batch in batchs[i:i+concurrency]])
-                
-            for c in range(len(contents)):
-                empty_response = {"sentiments": [{"item_id": i*25+c*25+j, "sentiment": None} for j in range(self.config.batch_size)]}
-                if contents[c] is None:
-                    logging.error("problem with model output")
-                    analysis.extend([empty_response])
-                    continue
-                parsed_content = self.parseModelResponse(contents[c]) # type:ignore
-                if parsed_content:
-                    analysis.extend(parsed_content)
-                else:
-                    analysis.extend([empty_response])
+        self.calculate_file_state(nb_batchs,0,skipped_items)
+        slots = asyncio.Semaphore(concurrency)
+        progress = tqdm(total=nb_batchs,unit="batch")
+        async def analyse(batch:list[dict])->str|list[dict]|None:
+            async with slots:
+                content = await self.sentimentAnaysisWorkflow(batch)
+            progress.update(1)
+            return content
+        try:
+            contents:list[str|list[dict]|None] = await asyncio.gather(*[analyse(batch) for batch in batchs])
+        finally:
+            progress.close()
+
+        analysis = []
+        for batch,content in zip(batchs,contents):
+            # a failed batch keeps its own item_ids with an empty sentiment
+            empty_response = [{"item_id": item["item_id"], "sentiment": None} for item in batch]
+            if content is None:
+                logging.error("problem with model output")
+                analysis.extend(empty_response)
+                continue
+            # streamed and compact batches come back already parsed, streamed ones possibly partial
+            parsed_content = content if isinstance(content,list) else self.parseModelResponse(content)
+            if parsed_content:
+                analysis.extend(parsed_content)
+            else:
+                analysis.extend(empty_response)
         return analysis
 
 
+    def trainClassifier(self,gold:pl.DataFrame)->None:
+        """
+        Trains the pre-classifier on LLM labelled gold data and stores it to cascade.model_path.
+
+        The cascade stays disabled when there are not enough labelled reviews.
+        """
+        cascade = self.config.cascade
+        if gold.height < cascade.min_training_rows:
+            logging.warning(f"only {gold.height} labelled reviews, pre-classifier cascade disabled")
+            return
+        classifier = PreClassifier().fit(gold["review"].to_list(), gold["sentiment"].to_list())
+        classifier.save(cascade.model_path)
+        self.classifier = classifier
+
+    def preClassify(self,data:pl.DataFrame)->tuple[pl.DataFrame,pl.DataFrame]:
+        """
+        Splits reviews into the ones labelled on CPU and the ones escalated to the LLM.
+
+        A random audit_rate share of the confident reviews is escalated as well so the
+        agreement of the direct labels with the LLM can be measured.
+
+        Returns:
+            (item_id/sentiment frame of direct labels, rows to send to the LLM)
+        """
+        cascade = self.config.cascade
+        proba = self.classifier.predictProba(data["review"].to_list()) # type:ignore
+        confident = (proba >= cascade.threshold) | (proba <= 1 - cascade.threshold)
+        audit = confident & (np.random.default_rng().random(proba.size) < cascade.audit_rate)
+        self.predictions = data.select("item_id").with_columns(
+            pl.Series("predicted", proba >= 0.5),
+            pl.Series("confident", confident),
+            pl.Series("audit", audit),
+        )
+        direct = (self.predictions
+                  .filter(pl.col("confident") & ~pl.col("audit"))
+                  .select("item_id", pl.col("predicted").alias("sentiment")))
+        escalated = data.filter(pl.Series(~confident | audit))
+        logging.info(f"pre-classifier labelled {direct.height} reviews, {escalated.height} escalated to the LLM")
+        return direct, escalated
+
+    def cascadeStats(self,analysis_df:pl.DataFrame)->dict:
+        """Agreement between the pre-classifier and the LLM on the reviews both labelled."""
+        checked = self.predictions.join(analysis_df.select("item_id","sentiment").drop_nulls(),on="item_id",how="inner")
+        def agreement(frame:pl.DataFrame)->float|None:
+            return float((frame["predicted"] == frame["sentiment"]).mean()) if frame.height else None # type:ignore
+        total = self.predictions.height
+        direct = self.predictions.filter(pl.col("confident") & ~pl.col("audit")).height
+        return {
+            "reviews": total,
+            "direct": direct,
+            "escalated": total - direct,
+            "llm_calls_saved": direct / total if total else 0.0,
+            "audit_agreement": agreement(checked.filter(pl.col("audit"))),
+            "escalated_agreement": agreement(checked.filter(~pl.col("confident"))),
+            "threshold": self.config.cascade.threshold,
+        }
+
+    def additiveColumns(self)->list[pl.Expr]:
+        """Price sum and count, kept when several workers have to merge their KPIs."""
+        if not self.config.coordination.enabled:
+            return []
+        return [pl.col("price").sum().alias("price_sum"),pl.col("price").count().alias("price_count")]
+
     def KPIs(self, group_by_shop: Any ,colname:str,key:str)->pl.DataFrame:
-        sales = group_by_shop.agg(pl.col("price").mean().alias(colname)).collect()
+        sales = group_by_shop.agg(pl.col("price").mean().alias(colname),*self.additiveColumns()).collect(engine=self.engine)
         count_reviews = group_by_shop.agg(pl.col("sentiment").sum().alias("positive_reviews"),
                                           (~pl.col("sentiment")).sum().alias("negative_reviews")
-                                          ).collect()
+                                          ).collect(engine=self.engine)
         review_score = (count_reviews.
                         with_columns((
                             pl.col("positive_reviews")/
@@ -127,33 +345,146 @@ class DataTransformer:
         sales = sales.join(normalized_score,on=key,how="left")
         return sales
     
-    def generateShopKpis(self,data:pl.DataFrame)->pl.DataFrame:
+    def generateShopKpis(self,data:pl.DataFrame|pl.LazyFrame)->pl.DataFrame:
         group_by_shop = data.lazy().group_by(pl.col("shop_id"))
         sales_by_shop = self.KPIs(group_by_shop,"average_profit","shop_id")
         return sales_by_shop
 
-    def generateUserKpis(self,data:pl.DataFrame)->pl.DataFrame:
+    def generateUserKpis(self,data:pl.DataFrame|pl.LazyFrame)->pl.DataFrame:
         group_by_user = data.lazy().group_by(pl.col("id"))
         sales_by_user = self.KPIs(group_by_user,"average_spent","id")
         return sales_by_user
     ## generate kpi based on the dates 
-    def generateDateKpis(self,data:pl.DataFrame)->pl.DataFrame:
+    def generateDateKpis(self,data:pl.DataFrame|pl.LazyFrame)->pl.DataFrame:
         group_by_date = data.lazy().group_by(pl.col("date"))
-        sales_by_date = group_by_date.agg(pl.col("price").mean().alias("average_profit_per_day")).collect()
+        sales_by_date = group_by_date.agg(pl.col("price").mean().alias("average_profit_per_day"),*self.additiveColumns()).collect(engine=self.engine)
         return sales_by_date
 
     def transform(self,data:pl.DataFrame)->list[pl.DataFrame]:
-        batchs = create_batches(data)
-        analysis = asyncio.run(self.sentmentAnalysis(batchs))
+        return asyncio.run(self.transformAsync(data))
+
+    async def labelReviews(self,data:pl.DataFrame,known:pl.DataFrame|None=None)->pl.DataFrame:
+        """
+        Labels every review of data, through the pre-classifier cascade when it is enabled.
+
+        Args:
+            data: Reviews to label
+            known: item_id/sentiment/label_source frame of reviews already labelled, e.g. by the estimation sample
+
+        Returns:
+            item_id/sentiment/label_source frame, label_source is llm or classifier
+        """
+        direct, to_label = pl.DataFrame(), data
+        if known is not None and not known.is_empty():
+            known = known.select(LABEL_COLUMNS).drop_nulls("sentiment")
+            to_label = data.join(known,on="item_id",how="anti")
+        if self.classifier is not None:
+            direct, to_label = self.preClassify(to_label)
+        batchs = create_batches(to_label)
+        analysis = await self.sentmentAnalysis(batchs,skipped_items=data.height - to_label.height)
         analysis_df = pl.DataFrame(analysis)
+        if "item_id" not in analysis_df.columns:
+            # nothing went to the LLM, e.g. the pre-classifier was confident on every review
+            analysis_df = pl.DataFrame(schema={"item_id":pl.Int64,"sentiment":pl.Boolean})
+        # the model answers Int64 ids, join keys must share the extracted dtype
+        analysis_df = analysis_df.with_columns(pl.col("item_id").cast(data.schema["item_id"],strict=False),
+                                               pl.lit("llm").alias("label_source"))
+        if self.classifier is not None:
+            self.cascade_stats = self.cascadeStats(analysis_df)
+            logging.info(f"pre-classifier cascade stats: {self.cascade_stats}")
+            analysis_df = pl.concat([analysis_df.select(LABEL_COLUMNS),
+                                     direct.with_columns(pl.lit("classifier").alias("label_source"))],how="vertical_relaxed")
+        if known is not None and not known.is_empty():
+            analysis_df = pl.concat([analysis_df.select(LABEL_COLUMNS),known],how="vertical_relaxed")
+        return analysis_df
+
+    async def estimateKpis(self,data:pl.DataFrame)->tuple[pl.DataFrame,pl.DataFrame,pl.DataFrame]:
+        """
+        Labels the stratified sample of KPIEstimator only and estimates the shop and user KPIs from it.
+
+        The file bookkeeping is left untouched, labelling a sample does not process a file.
+
+        Returns:
+            (shop estimates, user estimates, labels of the sample for the full labelling)
+        """
+        empty = (pl.DataFrame(),pl.DataFrame(),pl.DataFrame())
+        files_moved, filesize = list(self.config.file_to_move), list(self.config.filesize)
+        try:
+            labels = await self.labelReviews(self.estimator.sample(data)) # type:ignore
+            if "sentiment" not in labels.columns:
+                logging.error("no review of the estimation sample could be labelled")
+                return empty
+            return (self.estimator.estimate(data,labels,"shop_id"), # type:ignore
+                    self.estimator.estimate(data,labels,"id"), # type:ignore
+                    labels.select(LABEL_COLUMNS))
+        except Exception as e:
+            logging.error(f"Error during KPI estimation: {e}")
+            return empty
+        finally:
+            self.config.file_to_move, self.config.filesize = files_moved, filesize
+
+    async def transformAsync(self,data:pl.DataFrame,known:pl.DataFrame|None=None)->list[pl.DataFrame]:
+        """
+        Same as transform, for callers that keep a running event loop (and warm LLM connections).
+
+        known labels, e.g. those of the estimation sample, are reused instead of asking the LLM again.
+        """
         try:
+            analysis_df = await self.labelReviews(data,known)
             final_data = data.join(analysis_df,on="item_id",how="left")
             user_kpis = self.generateUserKpis(final_data)
             shop_kpis = self.generateShopKpis(final_data)
             date_kpis = self.generateDateKpis(final_data)
+            logging.info(f"llm endpoints stats: {self.router.stats()} hedging: {self.router.hedgeStats()}")
             logging.info("transformation process finished")
             return [final_data,user_kpis,shop_kpis,date_kpis]
         except Exception as e:
             logging.error(f"Error during transformation: {e}")
             return [pl.DataFrame(),pl.DataFrame(),pl.DataFrame(),pl.DataFrame()]
-    
\ No newline at end of file
+
+    async def transformLazy(self,raw:pl.LazyFrame,spool_dir:str,chunk_rows:int)->tuple[str|None,pl.DataFrame,pl.DataFrame,pl.DataFrame]:
+        """
+        Out-of-core transformation over spooled files.
+
+        Reviews are labelled chunk by chunk and the labels spooled to parquet, the
+        join and the KPI aggregations then run on the streaming engine so peak memory
+        is bounded by chunk_rows rather than by the size of the backlog.
+
+        Args:
+            raw: LazyFrame scanning the spooled extraction output
+            spool_dir: Directory for the intermediate files
+            chunk_rows: Rows labelled per chunk
+
+        Returns:
+            (path of the spooled final data as NDJSON, user kpis, shop kpis, date kpis)
+        """
+        empty = (None,pl.DataFrame(),pl.DataFrame(),pl.DataFrame())
+        try:
+            total = raw.select(pl.len()).collect(engine="streaming").item()
+            for offset in range(0,total,chunk_rows):
+                chunk = raw.slice(offset,chunk_rows).select("item_id","id","review").collect(engine="streaming")
+                analysis_df = await self.labelReviews(chunk)
+                analysis_df.select(LABEL_COLUMNS).write_parquet(os.path.join(spool_dir,f"sentiments_{offset}.parquet"))
+            if total == 0:
+                return empty
+            # every spooled row is labelled at this point, whatever the per batch bookkeeping says
+            self.config.file_to_move = list(self.config.files)
+
+            final_path = os.path.join(spool_dir,"final_data.parquet")
+            (raw.join(pl.scan_parquet(os.path.join(spool_dir,"sentiments_*.parquet")),on="item_id",how="left")
+                .sink_parquet(final_path))
+            final_data = pl.scan_parquet(final_path)
+            self.engine = "streaming"
+            user_kpis = self.generateUserKpis(final_data)
+            shop_kpis = self.generateShopKpis(final_data)
+            date_kpis = self.generateDateKpis(final_data)
+            gold_path = os.path.join(spool_dir,"final_data.ndjson")
+            final_data.sink_ndjson(gold_path)
+            logging.info(f"llm endpoints stats: {self.router.stats()} hedging: {self.router.hedgeStats()}")
+            logging.info("out-of-core transformation process finished")
+            return (gold_path,user_kpis,shop_kpis,date_kpis)
+        except Exception as e:
+            logging.error(f"Error during out-of-core transformation: {e}")
+            return empty
+        finally:
+            self.engine = "auto"
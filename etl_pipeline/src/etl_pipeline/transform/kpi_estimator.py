@@ -0,0 +1,136 @@
+"""
+Sample-based estimation of the review KPIs.
+
+The shop and user likeness scores only depend on the share of positive reviews
+per key, so they can be estimated from a sample instead of labelling every review.
+Each shop is a stratum: its sample size is the smallest one giving a positive
+rate within +/- margin at the configured confidence in the worst case (p = 0.5),
+with the finite population correction so small strata are not oversampled.
+Users are only strata of their own when user_margin is set: with many users of a
+few reviews each, any useful user margin draws most of their reviews, so by
+default the user estimates come from the rows the shops sampled and carry wider
+intervals. The LLM only labels the union of the stratum samples.
+
+Every row gets a pseudo-random draw derived from its item_id and the first n_k rows
+by draw of each shop form its sample. A user counts the rows of its own already
+sampled through its shops and only draws the rows its quota still misses. The
+draw does not depend on the review, so the shared rows are a random subset of
+the user's reviews as well. The intervals are Wilson score intervals with the
+finite population correction.
+"""
+
+import logging
+from statistics import NormalDist
+
+import polars as pl
+
+from ..models import ETLConfig
+
+logger = logging.getLogger(__name__)
+
+STRATA = {"shop_id": "average_profit", "id": "average_spent"}
+MARGINS = {"shop_id": "margin", "id": "user_margin"}
+DRAW_SEED = 7
+# above this share of the reviews the estimation saves little over labelling everything
+COSTLY_SHARE = 0.5
+ESTIMATES = ["positive_rate", "positive_rate_low", "positive_rate_high",
+             "likeness_score", "likeness_score_low", "likeness_score_high"]
+
+
+def sample_size(population: pl.Expr, margin: float, z: float) -> pl.Expr:
+    """Rows to sample from a stratum of population rows, worst case p = 0.5."""
+    n0 = z * z * 0.25 / (margin * margin)
+    return (n0 / (1 + (n0 - 1) / population)).ceil().clip(upper_bound=population).cast(pl.UInt32)
+
+
+class KPIEstimator:
+    """Draws the stratified review sample and estimates the KPIs from its labels."""
+
+    def __init__(self, config: ETLConfig) -> None:
+        self.config = config.estimation
+        self.z = NormalDist().inv_cdf((1 + self.config.confidence) / 2)
+
+    def quota(self, key: str) -> pl.Expr:
+        """Sample size of each row's stratum for key."""
+        return sample_size(pl.len().over(key), getattr(self.config, MARGINS[key]), self.z)
+
+    def quotas(self, data: pl.DataFrame) -> pl.DataFrame:
+        """
+        Flags the rows drawn for each stratum.
+
+        Returns:
+            data with one boolean sampled_<key> column per stratum
+        """
+        # the draw only depends on the item_id, a rerun on the same files picks the same sample
+        draw = pl.col("item_id").hash(DRAW_SEED)
+        shops = data.with_columns((draw.rank("ordinal").over("shop_id") <= self.quota("shop_id")).alias("sampled_shop_id"))
+        shared = pl.col("sampled_shop_id")
+        if self.config.user_margin is None:
+            return shops.with_columns(shared.alias("sampled_id"))
+        missing = self.quota("id").cast(pl.Int64) - shared.cast(pl.Int64).sum().over("id")
+        # only the rows no shop sampled are ranked, the user draws what its quota still misses among them
+        drawn = pl.when(~shared).then(draw).rank("ordinal").over("id") <= missing
+        return shops.with_columns((shared | drawn.fill_null(False)).alias("sampled_id"))
+
+    def sample(self, data: pl.DataFrame) -> pl.DataFrame:
+        """Rows of data that need a label, the union of the stratum samples."""
+        flagged = self.quotas(data)
+        sample = flagged.filter(pl.any_horizontal(f"sampled_{key}" for key in STRATA)).drop(f"sampled_{key}" for key in STRATA)
+        share = sample.height / max(data.height, 1)
+        users = "no user strata" if self.config.user_margin is None else f"a +/-{self.config.user_margin} user margin"
+        logger.info(f"estimation sample of {sample.height} reviews out of {data.height} "
+                    f"({share:.1%}) for a +/-{self.config.margin} shop margin and {users} at {self.config.confidence:.0%}")
+        if share > COSTLY_SHARE:
+            logger.warning(f"the estimation sample holds {share:.1%} of the reviews, it barely saves any labelling, "
+                           f"loosen the estimation margins or leave the user strata off (user_margin)")
+        return sample
+
+    def wilson(self, positives: pl.Expr, sampled: pl.Expr, population: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+        """Wilson score bounds of the positive rate, narrowed by the finite population correction."""
+        fpc = pl.when(population > 1).then((population - sampled) / (population - 1)).otherwise(0.0).clip(lower_bound=0.0)
+        z2 = self.z * self.z * fpc
+        rate = positives / sampled
+        center = (rate + z2 / (2 * sampled)) / (1 + z2 / sampled)
+        half = (z2.sqrt() / (1 + z2 / sampled)) * (rate * (1 - rate) / sampled + z2 / (4 * sampled * sampled)).sqrt()
+        return (center - half).clip(lower_bound=0.0), (center + half).clip(upper_bound=1.0)
+
+    def estimate(self, data: pl.DataFrame, labels: pl.DataFrame, key: str) -> pl.DataFrame:
+        """
+        Estimates the KPIs of one stratum key.
+
+        Args:
+            data: Every row of the run, the averages of the price are exact
+            labels: item_id/sentiment frame of the sample
+            key: Stratum column, shop_id or id
+
+        Returns:
+            One row per key with the estimated positive rate, likeness score and their bounds
+        """
+        flagged = self.quotas(data).join(labels.select("item_id", "sentiment"), on="item_id", how="left")
+        labelled = pl.col(f"sampled_{key}") & pl.col("sentiment").is_not_null()
+        estimates = flagged.group_by(key).agg(
+            pl.col("price").mean().alias(STRATA[key]),
+            pl.len().alias("reviews"),
+            labelled.sum().alias("sampled"),
+            (labelled & pl.col("sentiment")).sum().alias("sampled_positive"),
+        )
+        population, sampled = pl.col("reviews"), pl.col("sampled")
+        low, high = self.wilson(pl.col("sampled_positive"), sampled, population)
+        rate = pl.col("sampled_positive") / sampled
+
+        def likeness(p: pl.Expr) -> pl.Expr:
+            # same ratio as DataTransformer.KPIs on the estimated counts of the whole stratum
+            return p * population / pl.max_horizontal((1 - p) * population, pl.lit(1.0))
+
+        estimates = (estimates
+                     .with_columns(rate.alias("positive_rate"), low.alias("positive_rate_low"), high.alias("positive_rate_high"))
+                     .with_columns(likeness(pl.col("positive_rate")).alias("likeness_score"),
+                                   likeness(pl.col("positive_rate_low")).alias("likeness_score_low"),
+                                   likeness(pl.col("positive_rate_high")).alias("likeness_score_high"),
+                                   pl.lit(self.config.confidence).alias("confidence"))
+                     .drop("sampled_positive"))
+        unlabelled = estimates.filter(sampled == 0).height
+        if unlabelled:
+            logging.warning(f"{unlabelled} {key} values have no labelled review in the sample, their estimates are left empty")
+        return estimates.with_columns(pl.when(sampled > 0).then(pl.col(ESTIMATES)))
+
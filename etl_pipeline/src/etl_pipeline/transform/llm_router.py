@@ -0,0 +1,249 @@
+"""
+LLM endpoint routing for the ETL pipeline.
+
+This module spreads chat completion requests over a pool of OpenAI-compatible
+servers (llama.cpp, Ollama), keeping track of their load, latency and health.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Collection
+
+from openai import AsyncOpenAI
+
+from ..models import ETLConfig, EndpointConfig, RouterConfig
+
+logger = logging.getLogger(__name__)
+
+
+class LLMEndpoint:
+    """Runtime state of a single OpenAI-compatible server."""
+
+    def __init__(self, config: EndpointConfig, model: str) -> None:
+        self.config = config
+        self.model = config.model or model
+        self.client = AsyncOpenAI(base_url=config.base_url, api_key="key")
+        self.outstanding = 0
+        self.latency: float | None = None
+        self.failures = 0
+        self.healthy = True
+        self.ejected_at = 0.0
+        self.completed = 0
+
+    @property
+    def name(self) -> str:
+        return self.config.base_url
+
+    def score(self, strategy: str) -> float:
+        """
+        Cost of sending one more request to this endpoint, lower is better.
+
+        Args:
+            strategy: least_outstanding or latency
+
+        Returns:
+            Load normalised by the endpoint weight
+        """
+        if strategy == "latency":
+            # unknown latency scores 0 so fresh endpoints get explored first
+            return (self.latency or 0.0) * (1 + self.outstanding / self.config.slots) / self.config.weight
+        return (self.outstanding + 1) / self.config.weight
+
+    def recordSuccess(self, elapsed: float, alpha: float) -> None:
+        self.latency = elapsed if self.latency is None else alpha * elapsed + (1 - alpha) * self.latency
+        self.failures = 0
+        self.completed += 1
+
+    def recordFailure(self, max_failures: int) -> None:
+        self.failures += 1
+        if self.healthy and self.failures >= max_failures:
+            self.healthy = False
+            self.ejected_at = time.monotonic()
+            logger.warning(f"endpoint {self.name} ejected after {self.failures} consecutive failures")
+
+
+class LLMRouter:
+    """Dispatches requests to the least loaded healthy endpoint of the pool."""
+
+    def __init__(self, config: ETLConfig) -> None:
+        self.config: RouterConfig = config.router
+        endpoints = self.config.endpoints or [EndpointConfig(base_url=config.base_url)]
+        self.endpoints = [LLMEndpoint(endpoint, config.model) for endpoint in endpoints]
+        self._probes: set[asyncio.Task] = set()
+        self.latencies: deque[float] = deque(maxlen=self.config.latency_window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @property
+    def capacity(self) -> int:
+        """Number of requests the healthy part of the pool can serve in parallel."""
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        return sum(endpoint.config.slots for endpoint in healthy or self.endpoints)
+
+    def pick(self, exclude: Collection[LLMEndpoint] = ()) -> LLMEndpoint:
+        """
+        Select the endpoint for the next request.
+
+        Ejected endpoints whose cooldown elapsed get a health probe scheduled.
+        When the whole pool is ejected the endpoint ejected the longest ago is used.
+
+        Args:
+            exclude: Endpoints to avoid if another one is left (hedged and failed over requests)
+        """
+        self._scheduleProbes()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        if not healthy:
+            logger.warning("no healthy LLM endpoint left, using the one ejected the longest ago")
+            others = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            return min(others or self.endpoints, key=lambda endpoint: endpoint.ejected_at)
+        others = [endpoint for endpoint in healthy if endpoint not in exclude]
+        return min(others or healthy, key=lambda endpoint: (endpoint.score(self.config.strategy), endpoint.outstanding))
+
+    def reserve(self, exclude: Collection[LLMEndpoint] = ()) -> LLMEndpoint:
+        """Pick an endpoint and count the request as outstanding right away, before any await."""
+        endpoint = self.pick(exclude)
+        endpoint.outstanding += 1
+        return endpoint
+
+    @asynccontextmanager
+    async def track(self, endpoint: LLMEndpoint, censor: bool = False) -> AsyncIterator[LLMEndpoint]:
+        """
+        Record the outcome of a request on a reserved endpoint and release it.
+
+        A cancelled request (the losing side of a hedge) counts neither as success nor failure.
+        With censor, its elapsed time still goes to the hedge latency window as a lower bound
+        of its latency, otherwise a window of only the fast completions would keep lowering
+        the deadline. The endpoint latency average is left alone.
+        """
+        start = time.monotonic()
+        try:
+            yield endpoint
+        except asyncio.CancelledError:
+            if censor:
+                self.latencies.append(time.monotonic() - start)
+            raise
+        except Exception:
+            endpoint.recordFailure(self.config.max_failures)
+            raise
+        else:
+            elapsed = time.monotonic() - start
+            endpoint.recordSuccess(elapsed, self.config.latency_alpha)
+            self.latencies.append(elapsed)
+        finally:
+            endpoint.outstanding -= 1
+
+    def hedgeDeadline(self) -> float | None:
+        """Seconds after which a request gets hedged, None while hedging is off or not calibrated."""
+        if not self.config.hedging or len(self.latencies) < self.config.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.config.hedge_percentile / 100))]
+
+    async def _send(self, request: Callable[[LLMEndpoint], Awaitable[Any]], endpoint: LLMEndpoint,
+                    censor: bool = False) -> Any:
+        """
+        Send request to the reserved endpoint, failing over to another one when it raises.
+
+        Each endpoint is tried at most once and at most max_attempts of them, so requests
+        in flight on a dying server are not lost before it gets ejected.
+        """
+        failed: list[LLMEndpoint] = []
+        while True:
+            try:
+                async with self.track(endpoint, censor):
+                    return await request(endpoint)
+            except Exception as e:
+                failed.append(endpoint)
+                retry = self.pick(exclude=failed)
+                if len(failed) >= self.config.max_attempts or retry in failed:
+                    raise
+                logger.warning(f"request failed on {endpoint.name}, retrying on {retry.name}: {e}")
+                endpoint = retry
+                endpoint.outstanding += 1
+
+    async def dispatch(self, request: Callable[[LLMEndpoint], Awaitable[Any]],
+                       is_valid: Callable[[Any], bool] = lambda result: True) -> Any:
+        """
+        Send request to the pool, hedging it when it runs past the latency deadline.
+
+        A request raising on its endpoint is retried on another one, see _send.
+        The hedge goes to another endpoint when one is healthy, otherwise to another slot
+        of the same one. The first valid result wins and the other request is cancelled,
+        which closes its connection and frees the server slot. Hedges are capped at
+        hedge_budget of all requests.
+
+        Args:
+            request: Coroutine function sending the request to the given endpoint
+            is_valid: Whether a result is usable, an invalid primary result waits for the hedge
+
+        Returns:
+            The winning result, or the last result/exception when none is valid
+        """
+        self.requests += 1
+        endpoint = self.reserve()
+        # a primary cancelled because its hedge won was slow, keep that in the latency window
+        primary = asyncio.ensure_future(self._send(request, endpoint, censor=True))
+        deadline = self.hedgeDeadline()
+        if deadline is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if done or self.hedges >= self.config.hedge_budget * self.requests:
+            return await primary
+
+        self.hedges += 1
+        hedge = asyncio.ensure_future(self._send(request, self.reserve(exclude=(endpoint,))))
+        pending = {primary, hedge}
+        last = primary
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and is_valid(task.result()):
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    last = task
+            return last.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _scheduleProbes(self) -> None:
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if endpoint.healthy or now - endpoint.ejected_at < self.config.cooldown:
+                continue
+            # push the next probe back so a slow probe is not scheduled twice
+            endpoint.ejected_at = now
+            task = asyncio.get_running_loop().create_task(self.probe(endpoint))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+
+    async def probe(self, endpoint: LLMEndpoint) -> bool:
+        """Re-admit an ejected endpoint if it answers the models listing."""
+        try:
+            await endpoint.client.models.list(timeout=5)
+        except Exception as e:
+            logger.info(f"endpoint {endpoint.name} still unhealthy: {e}")
+            return False
+        endpoint.healthy = True
+        endpoint.failures = 0
+        logger.info(f"endpoint {endpoint.name} re-admitted to the pool")
+        return True
+
+    def hedgeStats(self) -> dict:
+        return {"requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "deadline": self.hedgeDeadline()}
+
+    def stats(self) -> list[dict]:
+        return [{"endpoint": endpoint.name,
+                 "healthy": endpoint.healthy,
+                 "outstanding": endpoint.outstanding,
+                 "latency": endpoint.latency,
+                 "completed": endpoint.completed} for endpoint in self.endpoints]
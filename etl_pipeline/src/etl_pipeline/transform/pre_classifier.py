@@ -0,0 +1,109 @@
+"""
+CPU pre-classifier for the sentiment cascade.
+
+This module contains a small hashed n-gram logistic regression built on NumPy.
+It is trained on reviews the LLM already labelled (gold data) and is used to
+label obvious reviews before anything is sent to the LLM.
+"""
+
+import logging
+import os
+import re
+import zlib
+from typing import Iterable, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+class PreClassifier:
+    """Hashed word uni/bi-gram logistic regression."""
+
+    def __init__(self, n_features: int = 2**18, l2: float = 1e-6) -> None:
+        self.n_features = n_features
+        self.l2 = l2
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+
+    def hashTokens(self, text: str | None) -> np.ndarray:
+        """
+        Map a review to the unique hashed indices of its uni and bi-grams.
+
+        crc32 is used instead of hash() so features stay stable across processes.
+        """
+        tokens = TOKEN_PATTERN.findall((text or "").lower())
+        grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) % self.n_features for g in grams),
+                                     dtype=np.int64, count=len(grams)))
+
+    def vectorize(self, texts: Iterable[str | None]) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """
+        Build a sparse binary, l2 normalised design matrix in coordinate form.
+
+        Returns:
+            (row ids, feature indices, values, number of rows)
+        """
+        rows, cols, values = [], [], []
+        n = 0
+        for n, text in enumerate(texts, start=1):
+            indices = self.hashTokens(text)
+            if indices.size == 0:
+                continue
+            rows.append(np.full(indices.size, n - 1, dtype=np.int64))
+            cols.append(indices)
+            values.append(np.full(indices.size, 1 / np.sqrt(indices.size), dtype=np.float32))
+        if not rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0, dtype=np.float32), n
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(values), n
+
+    def _logits(self, rows: np.ndarray, cols: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+        return np.bincount(rows, weights=self.weights[cols] * values, minlength=n) + self.bias
+
+    def fit(self, texts: List[str | None], labels: List[bool], epochs: int = 50, learning_rate: float = 0.5) -> "PreClassifier":
+        """
+        Train with full batch AdaGrad on the logistic loss.
+
+        Args:
+            texts: Review texts
+            labels: LLM sentiments, True for positive
+            epochs: Number of passes over the data
+            learning_rate: AdaGrad step size
+
+        Returns:
+            The fitted classifier
+        """
+        rows, cols, values, n = self.vectorize(texts)
+        y = np.asarray(labels, dtype=np.float64)
+        grad_sq = np.full(self.n_features, 1e-8)
+        bias_sq = 1e-8
+        for _ in range(epochs):
+            error = 1 / (1 + np.exp(-self._logits(rows, cols, values, n))) - y
+            grad = np.bincount(cols, weights=error[rows] * values, minlength=self.n_features) / n + self.l2 * self.weights
+            grad_sq += grad**2
+            self.weights -= (learning_rate * grad / np.sqrt(grad_sq)).astype(np.float32)
+            bias_grad = error.mean()
+            bias_sq += bias_grad**2
+            self.bias -= learning_rate * bias_grad / np.sqrt(bias_sq)
+        accuracy = float(((self.predictProba(texts) >= 0.5) == (y == 1)).mean()) if n else 0.0
+        logger.info(f"pre-classifier trained on {n} reviews, training accuracy {accuracy:.3f}")
+        return self
+
+    def predictProba(self, texts: Iterable[str | None]) -> np.ndarray:
+        """Probability of each review being positive."""
+        return 1 / (1 + np.exp(-self._logits(*self.vectorize(texts))))
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, l2=self.l2)
+
+    @classmethod
+    def load(cls, path: str) -> "PreClassifier":
+        state = np.load(path)
+        classifier = cls(n_features=state["weights"].shape[0], l2=float(state["l2"]))
+        classifier.weights = state["weights"]
+        classifier.bias = float(state["bias"])
+        return classifier
@@ -0,0 +1,298 @@
+"""
+Mergeable sketches for approximate KPIs.
+
+This module keeps fixed-size summaries of the review stream that can be merged
+across runs and workers:
+    - distinct reviewers per shop with one HyperLogLog per shop (2^precision bytes each)
+    - top shops and users by review count with Misra-Gries summaries
+    - price percentiles with a merging t-digest
+
+Everything is vectorised with NumPy and serialises to one compressed .npz blob.
+"""
+
+import io
+import logging
+from typing import Iterable
+
+import numpy as np
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV_PRIME = np.uint64(0x100000001B3)
+
+
+def hash64(values: Iterable[str]) -> np.ndarray:
+    """
+    Hash strings to uint64 with FNV-1a and a splitmix64 finaliser.
+
+    Unlike hash() or Polars hashes this is stable across processes and library
+    versions, which sketches merged across runs and workers depend on.
+    """
+    data = np.array([str(value).encode("utf-8") for value in values], dtype=np.bytes_)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    matrix = data.view(np.uint8).reshape(data.size, data.dtype.itemsize)
+    hashes = np.full(data.size, FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in matrix.T:
+            # strings shorter than the widest one are NUL padded, padding is not hashed
+            hashes = np.where(column != 0, (hashes ^ column) * FNV_PRIME, hashes)
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94D049BB133111EB)
+        hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+class KeyedHyperLogLog:
+    """One HyperLogLog per key, stored as a (keys x 2^precision) uint8 register matrix."""
+
+    def __init__(self, precision: int = 10) -> None:
+        self.precision = precision
+        self.m = 1 << precision
+        self.keys: dict[str, int] = {}
+        self.registers = np.zeros((0, self.m), dtype=np.uint8)
+
+    def _rows(self, keys: np.ndarray) -> np.ndarray:
+        unique, inverse = np.unique(keys, return_inverse=True)
+        new = [key for key in unique.tolist() if key not in self.keys]
+        if new:
+            for key in new:
+                self.keys[key] = len(self.keys)
+            self.registers = np.vstack([self.registers, np.zeros((len(new), self.m), dtype=np.uint8)])
+        return np.array([self.keys[key] for key in unique.tolist()], dtype=np.int64)[inverse]
+
+    def add(self, keys: np.ndarray, hashes: np.ndarray) -> None:
+        """
+        Add hashed items to the sketch of their key.
+
+        Args:
+            keys: Key of every item
+            hashes: uint64 hash of every item, see hash64
+        """
+        if hashes.size == 0:
+            return
+        rows = self._rows(keys)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)
+        # rank = leading zeros of the remaining bits + 1
+        rank = np.full(hashes.size, 64 - self.precision + 1, dtype=np.uint8)
+        nonzero = rest != 0
+        rank[nonzero] = (64 - np.floor(np.log2(rest[nonzero].astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, (rows, index), rank)
+
+    def merge(self, other: "KeyedHyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError(f"cannot merge HyperLogLog sketches of precision {other.precision} and {self.precision}")
+        if not other.keys:
+            return
+        rows = self._rows(np.array(list(other.keys)))
+        self.registers[rows] = np.maximum(self.registers[rows], other.registers)
+
+    def estimate(self) -> pl.DataFrame:
+        if not self.keys:
+            return pl.DataFrame(schema={"key": pl.String, "distinct": pl.Float64})
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / np.sum(np.exp2(-self.registers.astype(np.float64)), axis=1)
+        zeros = np.sum(self.registers == 0, axis=1)
+        # linear counting is more accurate on small cardinalities
+        small = (raw <= 2.5 * self.m) & (zeros > 0)
+        estimate = np.where(small, self.m * np.log(self.m / np.maximum(zeros, 1)), raw)
+        return pl.DataFrame({"key": list(self.keys), "distinct": estimate})
+
+
+class HeavyHitters:
+    """
+    Misra-Gries summary keeping at most capacity counters.
+
+    Reported counts underestimate the true ones by at most (total - kept) / (capacity + 1).
+    It is used instead of Space-Saving because summing two summaries and trimming
+    them again is an exact merge, so workers and runs combine without extra error.
+    """
+
+    def __init__(self, capacity: int = 100) -> None:
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        self.total = 0
+
+    def add(self, counts: dict[str, int], total: int | None = None) -> None:
+        merged = dict(self.counts)
+        for key, count in counts.items():
+            merged[key] = merged.get(key, 0) + count
+        self.total += sum(counts.values()) if total is None else total
+        if len(merged) > self.capacity:
+            values = np.fromiter(merged.values(), dtype=np.int64, count=len(merged))
+            # subtract the (capacity + 1)-th largest count from every counter
+            threshold = int(np.partition(values, len(values) - self.capacity - 1)[len(values) - self.capacity - 1])
+            merged = {key: count - threshold for key, count in merged.items() if count > threshold}
+        self.counts = merged
+
+    def merge(self, other: "HeavyHitters") -> None:
+        self.add(other.counts, other.total)
+
+    @property
+    def error(self) -> float:
+        return (self.total - sum(self.counts.values())) / (self.capacity + 1)
+
+    def top(self) -> pl.DataFrame:
+        return (pl.DataFrame({"key": list(self.counts), "count": list(self.counts.values())},
+                             schema={"key": pl.String, "count": pl.Int64})
+                .with_columns(pl.lit(self.error).alias("max_error"))
+                .sort("count", descending=True))
+
+
+class TDigest:
+    """Merging t-digest with the k1 (arcsine) scale function."""
+
+    def __init__(self, compression: float = 200) -> None:
+        self.compression = compression
+        self.means = np.zeros(0, dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values: np.ndarray, weights: np.ndarray | None = None) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values_weights = np.ones(values.size) if weights is None else np.asarray(weights, dtype=np.float64)
+        keep = np.isfinite(values)
+        values, values_weights = values[keep], values_weights[keep]
+        if values.size == 0:
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, values_weights])
+        self._compress()
+
+    def _compress(self) -> None:
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        # every centroid spans at most one unit of the scale function
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        bucket = np.floor(k - k[0]).astype(np.int64)
+        bucket_weights = np.bincount(bucket, weights=weights)
+        bucket_sums = np.bincount(bucket, weights=weights * means)
+        used = bucket_weights > 0
+        self.means = bucket_sums[used] / bucket_weights[used]
+        self.weights = bucket_weights[used]
+
+    def merge(self, other: "TDigest") -> None:
+        if other.means.size == 0:
+            return
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self._compress()
+
+    def quantile(self, q: np.ndarray) -> np.ndarray:
+        if self.means.size == 0:
+            return np.full(len(q), np.nan)
+        cumulative = np.cumsum(self.weights)
+        centers = (cumulative - self.weights / 2) / cumulative[-1]
+        return np.interp(q, np.concatenate([[0.0], centers, [1.0]]),
+                         np.concatenate([[self.min], self.means, [self.max]]))
+
+
+class KPISketches:
+    """Approximate KPIs of the review stream with fixed memory per shop."""
+
+    QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+    def __init__(self, precision: int = 10, capacity: int = 100, compression: float = 200) -> None:
+        self.reach = KeyedHyperLogLog(precision)
+        self.top_shops = HeavyHitters(capacity)
+        self.top_users = HeavyHitters(capacity)
+        self.prices = TDigest(compression)
+
+    def update(self, data: pl.DataFrame | pl.LazyFrame, chunk_rows: int | None = None) -> None:
+        """
+        Add the rows of a run.
+
+        Args:
+            data: Final data with id, shop_id and price columns
+            chunk_rows: Rows of a LazyFrame collected at a time, every sketch merges chunk by chunk
+        """
+        if isinstance(data, pl.LazyFrame) and chunk_rows:
+            total = data.select(pl.len()).collect(engine="streaming").item()
+            for offset in range(0, total, chunk_rows):
+                self.update(data.slice(offset, chunk_rows).collect(engine="streaming"))
+            return
+        rows = data.lazy().select(pl.col("id").cast(pl.String), pl.col("shop_id").cast(pl.String), pl.col("price").cast(pl.Float64))
+        pairs, shops, users, prices = pl.collect_all([
+            rows.select("shop_id", "id").drop_nulls().unique(),
+            rows.drop_nulls("shop_id").group_by("shop_id").len(),
+            rows.drop_nulls("id").group_by("id").len(),
+            rows.select("price").drop_nulls(),
+        ])
+        self.reach.add(pairs["shop_id"].to_numpy(), hash64(pairs["id"].to_list()))
+        self.top_shops.add(dict(zip(shops["shop_id"].to_list(), shops["len"].to_list())))
+        self.top_users.add(dict(zip(users["id"].to_list(), users["len"].to_list())))
+        self.prices.add(prices["price"].to_numpy())
+
+    def merge(self, other: "KPISketches") -> None:
+        self.reach.merge(other.reach)
+        self.top_shops.merge(other.top_shops)
+        self.top_users.merge(other.top_users)
+        self.prices.merge(other.prices)
+
+    def report(self, name: str) -> pl.DataFrame | None:
+        """
+        Args:
+            name: reach, top_shops, top_users or price_quantiles
+
+        Returns:
+            The estimated KPI, None for an unknown name
+        """
+        if name == "reach":
+            return (self.reach.estimate()
+                    .rename({"key": "shop_id", "distinct": "distinct_reviewers"})
+                    .sort("distinct_reviewers", descending=True))
+        if name == "top_shops":
+            return self.top_shops.top().rename({"key": "shop_id", "count": "reviews"})
+        if name == "top_users":
+            return self.top_users.top().rename({"key": "id", "count": "reviews"})
+        if name == "price_quantiles":
+            quantiles = np.array(self.QUANTILES)
+            return pl.DataFrame({"quantile": quantiles, "price": self.prices.quantile(quantiles)})
+        return None
+
+    def toBytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            precision=self.reach.precision,
+            reach_keys=np.array(list(self.reach.keys), dtype=np.str_),
+            reach_registers=self.reach.registers,
+            capacity=self.top_shops.capacity,
+            shop_keys=np.array(list(self.top_shops.counts), dtype=np.str_),
+            shop_counts=np.array(list(self.top_shops.counts.values()), dtype=np.int64),
+            shop_total=self.top_shops.total,
+            user_keys=np.array(list(self.top_users.counts), dtype=np.str_),
+            user_counts=np.array(list(self.top_users.counts.values()), dtype=np.int64),
+            user_total=self.top_users.total,
+            compression=self.prices.compression,
+            means=self.prices.means,
+            weights=self.prices.weights,
+            bounds=np.array([self.prices.min, self.prices.max]),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def fromBytes(cls, blob: bytes) -> "KPISketches":
+        state = np.load(io.BytesIO(blob), allow_pickle=False)
+        sketches = cls(int(state["precision"]), int(state["capacity"]), float(state["compression"]))
+        sketches.reach.keys = {key: row for row, key in enumerate(state["reach_keys"].tolist())}
+        sketches.reach.registers = state["reach_registers"]
+        sketches.top_shops.counts = dict(zip(state["shop_keys"].tolist(), state["shop_counts"].tolist()))
+        sketches.top_shops.total = int(state["shop_total"])
+        sketches.top_users.counts = dict(zip(state["user_keys"].tolist(), state["user_counts"].tolist()))
+        sketches.top_users.total = int(state["user_total"])
+        sketches.prices.means = state["means"]
+        sketches.prices.weights = state["weights"]
+        sketches.prices.min, sketches.prices.max = state["bounds"].tolist()
+        return sketches
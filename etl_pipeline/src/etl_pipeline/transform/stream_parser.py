@@ -0,0 +1,137 @@
+"""
+Incremental parser for streamed sentiment responses.
+
+The model streams {"sentiments": [{"item_id": N, "sentiment": true}, ...]} token by
+token. This module emits every sentiment object as soon as its closing brace
+arrives and flags the stream as diverged as soon as the output leaves the schema,
+so the caller can stop a degenerate generation early.
+"""
+
+import json
+import logging
+import re
+from typing import Iterable, List
+
+from ..models import Sentiments
+
+logger = logging.getLogger(__name__)
+
+HEADER = re.compile(r'\s*\{\s*"sentiments"\s*:\s*\[')
+HEADER_TEXT = '{"sentiments":['
+MAX_OBJECT_LENGTH = 256
+
+
+class SentimentStreamParser:
+    """Feeds on streamed text and collects the completed sentiment objects."""
+
+    def __init__(self, expected_ids: Iterable[int]) -> None:
+        self.expected = set(expected_ids)
+        self.items: List[dict] = []
+        self.seen: set[int] = set()
+        self.diverged = False
+        self.closed = False
+        self.reason: str | None = None
+        self._buffer = ""
+        self._in_array = False
+        self._object_start: int | None = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._position = 0
+
+    @property
+    def done(self) -> bool:
+        """All expected ids arrived or the array was closed, the rest of the generation is not needed."""
+        return self.closed or (bool(self.expected) and self.seen >= self.expected)
+
+    def _diverge(self, reason: str) -> None:
+        self.diverged = True
+        self.reason = reason
+        logger.warning(f"streamed output diverged from the schema: {reason}")
+
+    def feed(self, text: str) -> List[dict]:
+        """
+        Consume a chunk of streamed text.
+
+        Args:
+            text: Next content delta of the stream
+
+        Returns:
+            Sentiment objects completed by this chunk
+        """
+        if self.diverged or self.closed:
+            return []
+        self._buffer += text
+        if not self._in_array:
+            match = HEADER.match(self._buffer)
+            if match is None:
+                # still a prefix of the header as long as nothing but it was produced
+                if not HEADER_TEXT.startswith(re.sub(r"\s+", "", self._buffer)):
+                    self._diverge("unexpected response header")
+                return []
+            self._in_array = True
+            self._position = match.end()
+
+        completed = []
+        while self._position < len(self._buffer) and not self.diverged:
+            char = self._buffer[self._position]
+            if self._object_start is None:
+                if char == "{":
+                    self._object_start = self._position
+                    self._depth = 1
+                elif char == "]":
+                    self.closed = True
+                    self._position = len(self._buffer)
+                    break
+                elif not (char.isspace() or char == ","):
+                    self._diverge(f"unexpected character {char!r} between objects")
+                    break
+            else:
+                self._scanObjectChar(char)
+                if self._depth == 0:
+                    item = self._parseObject(self._buffer[self._object_start:self._position + 1])
+                    if item is not None:
+                        completed.append(item)
+                    self._object_start = None
+                elif self._position - self._object_start > MAX_OBJECT_LENGTH:
+                    self._diverge("sentiment object too long")
+            self._position += 1
+
+        # drop what was consumed so the buffer stays small on long generations
+        cut = self._object_start if self._object_start is not None else self._position
+        self._buffer = self._buffer[cut:]
+        self._position -= cut
+        if self._object_start is not None:
+            self._object_start = 0
+        self.items.extend(completed)
+        return completed
+
+    def _scanObjectChar(self, char: str) -> None:
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+        elif char == '"':
+            self._in_string = True
+        elif char == "{":
+            self._depth += 1
+        elif char == "}":
+            self._depth -= 1
+
+    def _parseObject(self, raw: str) -> dict | None:
+        try:
+            item = Sentiments.model_validate(json.loads(raw)).model_dump()
+        except Exception as e:
+            self._diverge(f"invalid sentiment object {raw!r}: {e}")
+            return None
+        if item["item_id"] in self.seen:
+            self._diverge(f"item_id {item['item_id']} repeated")
+            return None
+        if self.expected and item["item_id"] not in self.expected:
+            self._diverge(f"unexpected item_id {item['item_id']}")
+            return None
+        self.seen.add(item["item_id"])
+        return item
@@ -0,0 +1,161 @@
+"""
+Sampled memory and CPU profiling of the pipeline stages.
+
+For a configurable fraction of runs this module records, per stage:
+    - wall time, RSS at start/end and peak RSS, polled from /proc by a sampler thread
+    - peak traced Python heap and the tracemalloc allocation sites that grew the most
+    - sampled stacks of every thread, written in the folded format read by
+      flamegraph.pl, speedscope or inferno
+
+Polars and the LLM clients allocate outside the Python heap, so their memory only
+shows up in RSS; tracemalloc points at the Python side (to_dicts, JSON building).
+"""
+
+import datetime
+import json
+import linecache
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from ..models import ProfilingConfig
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> int:
+    """Resident set size in bytes, the lifetime peak when /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageProfiler:
+    """Profiles the stages of one run out of 1/sample_rate, does nothing on the others."""
+
+    def __init__(self, config: ProfilingConfig) -> None:
+        self.config = config
+        self.active = False
+        self.stages: list[dict[str, Any]] = []
+        self.stacks: Counter[str] = Counter()
+        self._stage: dict[str, Any] | None = None
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._own_tracemalloc = False
+
+    def begin(self) -> bool:
+        """Decides whether this run is profiled and starts the samplers if so."""
+        self.active = self.config.enabled and random.random() < self.config.sample_rate
+        if not self.active:
+            return False
+        self.stages = []
+        self.stacks = Counter()
+        if self.config.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(self.config.traceback_frames)
+            self._own_tracemalloc = True
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sampleLoop, name="stage-profiler", daemon=True)
+        self._sampler.start()
+        return True
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Records one stage of a profiled run, usable around awaits."""
+        if not self.active:
+            yield
+            return
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if snapshot is not None:
+            tracemalloc.reset_peak()
+        rss = current_rss()
+        record: dict[str, Any] = {"stage": name, "rss_start": rss, "rss_peak": rss, "samples": 0}
+        self._stage = record
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stage = None
+            record["duration"] = time.perf_counter() - started
+            record["rss_end"] = current_rss()
+            record["rss_peak"] = max(record["rss_peak"], record["rss_end"])
+            if snapshot is not None:
+                record["python_peak"] = tracemalloc.get_traced_memory()[1]
+                record["top_allocations"] = self._topAllocations(snapshot)
+            self.stages.append(record)
+
+    def _topAllocations(self, before: tracemalloc.Snapshot) -> list[dict[str, Any]]:
+        # leave out the profiler's own snapshots
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        sites = []
+        for stat in after.compare_to(before.filter_traces(filters), "lineno")[:self.config.top_allocations]:
+            frame = stat.traceback[0]
+            sites.append({"site": f"{frame.filename}:{frame.lineno}",
+                          "code": linecache.getline(frame.filename, frame.lineno).strip(),
+                          "size_diff": stat.size_diff, "count_diff": stat.count_diff})
+        return sites
+
+    def _sampleLoop(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.config.interval):
+            record = self._stage
+            if record is None:
+                continue
+            record["rss_peak"] = max(record["rss_peak"], current_rss())
+            record["samples"] += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([record["stage"], *reversed(calls)])] += 1
+
+    def end(self) -> str | None:
+        """
+        Stops the samplers and writes the profile of the run.
+
+        Returns:
+            Directory holding summary.json and stacks.folded, None if the run was not profiled
+        """
+        if not self.active:
+            return None
+        self.active = False
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+            self._own_tracemalloc = False
+        directory = os.path.join(self.config.output_dir, datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "summary.json"), "w") as summary:
+                json.dump({"interval": self.config.interval, "stages": self.stages}, summary, indent=2)
+            with open(os.path.join(directory, "stacks.folded"), "w") as folded:
+                folded.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        except OSError as e:
+            logging.error(f"Error writing the run profile to {directory}: {e}")
+            return None
+        for record in self.stages:
+            logger.info(f"profile {record['stage']}: {record['duration']:.2f}s, "
+                        f"peak RSS {record['rss_peak'] / 2**20:.0f} MiB "
+                        f"(+{(record['rss_peak'] - record['rss_start']) / 2**20:.0f} MiB)")
+        logger.info(f"profile written to {directory}")
+        return directory
@@ -5,8 +5,10 @@ This module contains common helper functions and utilities used across
 different components of the ETL pipeline.
 """
 
+import json
 import logging
-from typing import List, Dict, Any
+import os
+from typing import Any, Callable, Dict, List
 import polars as pl
 
 
@@ -53,17 +55,31 @@ def generate_prompt(batch: List[Dict[str, Any]]) -> str:
     Generate prompt text for AI model from a batch of data.
     
     Args:
-        batch: List of data dictionaries containing id and review
+        batch: List of data dictionaries containing item_id and review
         
     Returns:
         Formatted prompt string for the AI model
     """
     prompt = "items :"
     for item in batch:
-        prompt += f"\n id : {item['id']} , review : {item['review']} \n"
+        prompt += f"\n item_id : {item['item_id']} , review : {item['review']} \n"
     return prompt
 
 
+def generate_compact_prompt(batch: List[Dict[str, Any]]) -> str:
+    """
+    Generate a numbered prompt for the compact positional output mode.
+    
+    Args:
+        batch: List of data dictionaries containing review
+        
+    Returns:
+        Prompt listing the reviews by position, the answer is mapped back by position
+    """
+    lines = [f"{position}. {item['review']}" for position, item in enumerate(batch, start=1)]
+    return f"{len(batch)} reviews :\n" + "\n".join(lines)
+
+
 def min_max_normalize(data: pl.DataFrame, column: str, new_column: str | None = None) -> pl.DataFrame:
     """
     Apply min-max normalization to a DataFrame column.
@@ -94,6 +110,127 @@ def min_max_normalize(data: pl.DataFrame, column: str, new_column: str | None =
     return normalized_data
 
 
+def merge_kpis(data: pl.DataFrame, existing: pl.DataFrame, key: str, average_column: str) -> pl.DataFrame:
+    """
+    Merge freshly computed KPIs with the stored ones through their additive columns.
+
+    Averages and likeness scores are not additive, they are rebuilt from the merged
+    price_sum/price_count and positive/negative review counts. Stored rows without
+    additive columns (written before they existed) contribute nothing.
+
+    normalized_likeness_score is not computed here: a worker only sees the keys it
+    touched, so a min-max over them would put every worker on its own scale, see
+    rescale_kpis.
+
+    Args:
+        data: KPIs of the current run, with additive columns
+        existing: KPI rows already stored for the same keys
+        key: Key column (id, shop_id, date)
+        average_column: Name of the average price column of the table
+
+    Returns:
+        Merged KPI rows ready to be upserted
+    """
+    additive = [col for col in ("price_sum", "price_count", "positive_reviews", "negative_reviews") if col in data.columns]
+    if existing.is_empty():
+        existing = data.clear()
+    else:
+        existing = existing.with_columns([pl.lit(0).alias(col) for col in additive if col not in existing.columns])
+    merged = (pl.concat([data.select(key, *additive), existing.select(key, *additive)], how="vertical_relaxed")
+              .group_by(key)
+              .agg([pl.col(col).fill_null(0).sum() for col in additive])
+              .with_columns((pl.col("price_sum") / pl.col("price_count")).alias(average_column)))
+    if "positive_reviews" in additive:
+        merged = merged.with_columns(
+            (pl.col("positive_reviews") /
+             pl.when(pl.col("negative_reviews") > 0)
+             .then(pl.col("negative_reviews"))
+             .otherwise(1)).cast(pl.Float64).alias("likeness_score"))
+    return merged
+
+
+def rescale_kpis(merged: pl.DataFrame, stored: pl.DataFrame, key: str) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Min-max normalise the likeness scores of merged KPIs over the whole stored table.
+
+    Stored rows of keys the run did not touch keep their likeness score, but their
+    normalised score moves with the table minimum and maximum.
+
+    Args:
+        merged: Merged KPI rows of the run, from merge_kpis
+        stored: key, likeness_score and normalized_likeness_score of every stored row
+        key: Key column (id, shop_id, date)
+
+    Returns:
+        (merged with normalized_likeness_score, key/normalized_likeness_score of the other
+        stored rows whose normalised score changed)
+    """
+    if stored.is_empty():
+        stored = pl.DataFrame(schema={key: pl.String, "likeness_score": pl.Float64, "normalized_likeness_score": pl.Float64})
+    # stored keys come back as strings from the API
+    others = (stored.with_columns(pl.col(key).cast(pl.String), pl.col("likeness_score", "normalized_likeness_score").cast(pl.Float64))
+              .filter(~pl.col(key).is_in(merged[key].cast(pl.String).implode())))
+    scores = pl.concat([merged["likeness_score"], others["likeness_score"]]).drop_nulls()
+    low, high = scores.min(), scores.max()
+
+    def normalise(column: str) -> pl.Expr:
+        if low is None or low == high:
+            return pl.lit(0.0).alias("normalized_likeness_score")
+        return ((pl.col(column) - low) / (high - low)).alias("normalized_likeness_score")
+
+    rescaled = (others.with_columns(normalise("likeness_score").alias("rescaled"))
+                .filter(pl.col("likeness_score").is_not_null()
+                        & pl.col("rescaled").ne_missing(pl.col("normalized_likeness_score")))
+                .select(key, pl.col("rescaled").alias("normalized_likeness_score")))
+    return merged.with_columns(normalise("likeness_score")), rescaled
+
+
+def merge_rollup(stored: pl.DataFrame, delta: pl.DataFrame, keys: List[str], measures: List[str]) -> pl.DataFrame:
+    """
+    Add the cube rows of a run to the stored ones, every rollup measure is additive.
+
+    Args:
+        stored: Cube rows already materialised, empty on the first run
+        delta: Cube rows aggregated from the new data only
+        keys: Dimension columns of the cube
+        measures: Additive measure columns
+
+    Returns:
+        Merged cube rows sorted by keys
+    """
+    if stored.is_empty():
+        stored = delta.clear()
+    stored = stored.select(*keys, *measures).cast({col: delta.schema[col] for col in keys})
+    return (pl.concat([stored, delta.select(*keys, *measures)], how="vertical_relaxed")
+            .group_by(keys)
+            .agg([pl.col(col).fill_null(0).sum() for col in measures])
+            .sort(keys))
+
+
+def fetch_all(query: Callable[[], Any], page_size: int = 1000) -> List[Dict[str, Any]]:
+    """
+    Read every row of a PostgREST select page by page.
+
+    PostgREST truncates a response to its max-rows setting (1000 by default) without
+    any error, so the rows are requested with .range() until a page comes back short.
+
+    Args:
+        query: Builds a fresh select with a total order, builders cannot be reused between requests
+        page_size: Rows per request, not above the server max-rows
+
+    Returns:
+        All the rows of the query
+    """
+    rows: List[Dict[str, Any]] = []
+    start = 0
+    while True:
+        page = query().range(start, start + page_size - 1).execute().data
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        start += page_size
+
+
 def validate_dataframe(df: pl.DataFrame, required_columns: List[str]) -> bool:
     """
     Validate that a DataFrame contains required columns.
@@ -115,3 +252,76 @@ def validate_dataframe(df: pl.DataFrame, required_columns: List[str]) -> bool:
     return True
 
 
+
+
+
+def write_stage(data: pl.DataFrame, stage_dir: str, name: str) -> str:
+    """
+    Persist a stage output as an uncompressed Arrow IPC file.
+
+    Compression is disabled on purpose: only uncompressed IPC buffers can be
+    memory-mapped by the next stage without a copy.
+
+    Args:
+        data: DataFrame to persist
+        stage_dir: Directory holding the stage outputs
+        name: Name of the output, without extension
+
+    Returns:
+        Path of the written file
+    """
+    os.makedirs(stage_dir, exist_ok=True)
+    path = os.path.join(stage_dir, f"{name}.arrow")
+    tmp_path = f"{path}.tmp"
+    data.write_ipc(tmp_path, compression="uncompressed")
+    # atomic rename so a crashed stage never leaves a half written handoff behind
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote {data.height} rows to {path}")
+    return path
+
+
+def read_stage(stage_dir: str, name: str) -> pl.DataFrame:
+    """
+    Memory-map a stage output written by write_stage.
+
+    Args:
+        stage_dir: Directory holding the stage outputs
+        name: Name of the output, without extension
+
+    Returns:
+        DataFrame backed by the mapped file
+    """
+    path = os.path.join(stage_dir, f"{name}.arrow")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"stage output {path} not found, run the previous stage first")
+    return pl.read_ipc(path, memory_map=True)
+
+
+def write_manifest(stage_dir: str, manifest: Dict[str, Any]) -> None:
+    """
+    Persist the file bookkeeping (files, sizes, files to move) shared between stages.
+
+    Args:
+        stage_dir: Directory holding the stage outputs
+        manifest: JSON serialisable bookkeeping
+    """
+    os.makedirs(stage_dir, exist_ok=True)
+    with open(os.path.join(stage_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+
+
+def read_manifest(stage_dir: str) -> Dict[str, Any]:
+    """
+    Read the bookkeeping written by write_manifest, empty if there is none.
+
+    Args:
+        stage_dir: Directory holding the stage outputs
+
+    Returns:
+        The manifest dictionary
+    """
+    path = os.path.join(stage_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the package imports itself as etl_pipeline.src.etl_pipeline, from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
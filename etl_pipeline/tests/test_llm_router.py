@@ -0,0 +1,103 @@
+"""Routing tests against mock OpenAI-compatible endpoints."""
+
+import asyncio
+
+import httpx
+import pytest
+from openai import APIConnectionError, AsyncOpenAI
+
+from etl_pipeline.src.etl_pipeline.models import ETLConfig, EndpointConfig, RouterConfig
+from etl_pipeline.src.etl_pipeline.transform.llm_router import LLMEndpoint, LLMRouter
+
+COMPLETION = {
+    "id": "mock",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "mock",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+}
+
+
+class MockServer:
+    """Answers chat completions and the models listing, refuses connections while down."""
+
+    def __init__(self, down: bool = False) -> None:
+        self.down = down
+        self.requests = 0
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.down:
+            raise httpx.ConnectError("connection refused", request=request)
+        if request.url.path.endswith("/models"):
+            return httpx.Response(200, json={"object": "list", "data": []})
+        self.requests += 1
+        return httpx.Response(200, json=COMPLETION)
+
+
+def mock_router(*servers: MockServer, **router) -> LLMRouter:
+    config = ETLConfig(bucket_name="bucket", path="path", model="mock", system_prompt="prompt",
+                       base_url="http://unused/v1/", destpath="dest",
+                       router=RouterConfig(endpoints=[EndpointConfig(base_url=f"http://mock{index}/v1/")
+                                                      for index in range(len(servers))], **router))
+    llm_router = LLMRouter(config)
+    for endpoint, server in zip(llm_router.endpoints, servers):
+        # no client side retries, every failure reaches the router
+        endpoint.client = AsyncOpenAI(base_url=endpoint.name, api_key="key", max_retries=0,
+                                      http_client=httpx.AsyncClient(transport=httpx.MockTransport(server.handle)))
+    return llm_router
+
+
+async def complete(endpoint: LLMEndpoint) -> str:
+    response = await endpoint.client.chat.completions.create(
+        messages=[{"role": "user", "content": "review"}], model=endpoint.model)
+    return response.choices[0].message.content
+
+
+def test_failover_keeps_burst_batches():
+    down, up = MockServer(down=True), MockServer()
+    router = mock_router(down, up)
+
+    async def burst():
+        return await asyncio.gather(*[router.dispatch(complete) for _ in range(10)])
+
+    assert asyncio.run(burst()) == ["ok"] * 10
+    assert up.requests == 10
+    assert not router.endpoints[0].healthy
+
+
+def test_failing_endpoint_is_ejected():
+    down, up = MockServer(down=True), MockServer()
+    router = mock_router(down, up, max_failures=2)
+
+    async def sequential():
+        for _ in range(6):
+            await router.dispatch(complete)
+
+    asyncio.run(sequential())
+    assert not router.endpoints[0].healthy
+    assert router.endpoints[0].failures == 2
+    assert router.capacity == router.endpoints[1].config.slots
+
+
+def test_recovered_endpoint_is_readmitted():
+    flaky, up = MockServer(down=True), MockServer()
+    router = mock_router(flaky, up, max_failures=1, cooldown=0)
+
+    async def recover():
+        await router.dispatch(complete)
+        assert not router.endpoints[0].healthy
+        flaky.down = False
+        router.pick()
+        await asyncio.gather(*router._probes)
+
+    asyncio.run(recover())
+    assert router.endpoints[0].healthy
+    assert router.endpoints[0].failures == 0
+
+
+def test_attempts_are_bounded_when_the_pool_is_down():
+    servers = [MockServer(down=True) for _ in range(3)]
+    router = mock_router(*servers, max_attempts=2)
+    with pytest.raises(APIConnectionError):
+        asyncio.run(router.dispatch(complete))
+    assert sum(endpoint.failures for endpoint in router.endpoints) == 2